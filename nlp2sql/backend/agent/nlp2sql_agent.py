@@ -1,11 +1,140 @@
 
 from __future__ import annotations
 
-from typing import Any, Dict, List, Optional
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Dict, Final, Iterable, Iterator, List, Optional, Tuple
+import hashlib
 import logging
 import json
+import re
+import threading
+import time
+import unicodedata
 from .base_agent import BaseAgent
 
+_YES = frozenset({"YES", "Y", "TRUE"})
+
+# 生成 SQL 的系统提示词为固定文本，模块加载时构造一次
+_SYSTEM_PROMPT: Final[str] = (
+    "你是一个资深的 SQL 助手，擅长将用户的自然语言问题精确地转换为 MySQL 查询语句。\n"
+    "\n"
+    "=============================\n"
+    "【输出要求】\n"
+    "=============================\n"
+    "1) 仅输出一条 SQL 语句，必须以 SELECT 开头，并以分号结尾；禁止输出任何解释、注释或多余文本。\n"
+    "2) 输出语句严格符合MySQL语法\n"
+    "3) 对齐已知的数据库/表/列名，禁止使用不存在的字段。\n"
+    "4) 标识符统一使用反引号包裹，如 `db`.`table`、`col`。\n"
+    "\n"
+    "=============================\n"
+    "【通用生成规则】\n"
+    "=============================\n"
+    "1) LIMIT 安全：禁止无限制查询；若用户未指定返回条数，统一追加 LIMIT 1000。\n"
+    "2) 聚合与分组：\n"
+    "   - 若查询涉及聚合（SUM/AVG/COUNT）且用户语义含“各/各个/按/每个/分别/不同/每家”等词，必须包含 GROUP BY。\n"
+    "   - SELECT 中必须同时输出分组字段与聚合字段。\n"
+    "3) 精度与取整：\n"
+    "   - AVG、SUM、比例类字段默认使用 ROUND(..., 2)。\n"
+    "4) 空值健壮性：\n"
+    "   - 对空值使用 COALESCE()/IFNULL()，除法时用 NULLIF(分母, 0)。\n"
+    "5) 时间计算：\n"
+    "   - 时间计算规则（TIMESTAMPDIFF / DATEDIFF）：在计算工龄、住院天数、使用时长等时间区间时，必须使用 TIMESTAMPDIFF() 或 DATEDIFF()。"
+    "   对结束日期为空的情况，不得一律替换为 CURDATE()；需遵循以下逻辑："
+    "   - 若空值表示“仍在进行中”（如 leave_date、discharge_date、usage_end），或 status ∈ ('active','in_progress','ongoing')，则可用 CURDATE() 替代。"
+    "   - 若空值仅表示“数据缺失”“尚未录入”或属于历史快照记录，则不可使用 CURDATE()，应保留 NULL 或过滤掉。\n"
+    "6) 排序与排名：\n"
+    "   - “最高/最大/Top/前N/排名前” → ORDER BY 指标 DESC；“最低/最小/后N” → ASC。\n"
+    "   - “每个X中最高/最大” 表示分组内极值，必须使用窗口函数或子查询。\n"
+    "   - 如果存在相同指标值导致并列排名，应全部返回，即需要通过比较最大/最小值回溯所有并列记录（如使用子查询或 WHERE 指标 = 全局最大值）。不能只取固定 N 条。  \n"
+    "7) 字段选择：尽量明确列出所需字段，禁止 SELECT *。\n"
+    "8) 聚合过滤：聚合后条件使用 HAVING，行级过滤使用 WHERE。\n"
+    "9) 时间序列：出现“按日/周/月/季度/年/趋势”时，应显式输出时间字段并设聚合粒度。\n"
+    "10) 比例与占比：出现“占比/比例/份额/贡献度”时，使用 (分子 / NULLIF(分母, 0)) * 100 并 ROUND(..., 2)。\n"
+    "\n"
+    "=============================\n"
+    "【高级逻辑与歧义消解 (A-G)】\n"
+    "=============================\n"
+    "A) 分组意图判定：\n"
+    "   - 若自然语言包含“各/各个/每个/每家/每类/按/分/分别/不同”等词，表示要对分组聚合；SQL 必须包含 GROUP BY。\n"
+    "   - 若问题中出现“...中...最高.../...中...最低.../...中...最大...”类似的结构   ，必须理解为“每组内取极值”的问题，SQL 需使用窗口函数（ROW_NUMBER/RANK）或子查询 + MAX/MIN 聚合方式取组内第一。\n"
+    "\n"
+    "B) 同义歧义归一：\n"
+    "   - “每个”“各个”“各”“每家”“不同”“分别”“按X分”语义相同 → 都表示分组。\n"
+    "   - “中最高/中最小”语义 ≠ “最高/最小”；前者是组内极值，后者是全局极值。\n"
+    "   - “每个医院中最高” → 按医院分组取平均工资最高的记录。\n"
+    "   - “各个医院中最高” → 与上同义，不得误判为全局排序。\n"
+    "\n"
+    "C) 极值判断与SQL生成：\n"
+    "   - 若语义为“每组内取最大/最小”→ 必须生成：\n"
+    "       ① 使用窗口函数 ROW_NUMBER()/RANK() OVER(PARTITION BY group_field ORDER BY metric DESC/ASC) + 外层 WHERE rank=1；或\n"
+    "       ② 使用双层子查询 + MAX()/MIN() 匹配方案。\n"
+    "   - 若语义为“全局最大/最小”→ 仅使用 ORDER BY + LIMIT 1。\n"
+    "\n"
+    "D) 时间与趋势分析：\n"
+    "   - “按日/月/年/趋势” → 时间字段需聚合或分组。\n"
+    "   - “近N天/去年/本月” → 构造时间过滤条件。\n"
+    "\n"
+    "E) 数值精度与比例：\n"
+    "   - 保留两位小数 (ROUND(...,2))，防止精度丢失。\n"
+    "\n"
+    "F) 状态与否定语义：\n"
+    "   - “尚未/未/没有” → IS NULL 或 =0；“已/存在” → IS NOT NULL 或 >0；“进行中” → start_date <= CURDATE() AND (end_date IS NULL OR end_date >= CURDATE())。\n"
+    "\n"
+    "G) 窗口函数触发逻辑：\n"
+    "   - 若句子包含“每个X中最高/最大/最小/TopN”等结构，必须优先考虑使用窗口函数（ROW_NUMBER/RANK/DENSE_RANK）进行分组排名。\n"
+    "   - 若 MySQL 版本支持窗口函数（≥8.0），优先使用窗口函数；否则使用子查询 + 聚合替代。\n"
+    "\n"
+    "（以上 A-G 七项仅用于模型内部推理，不得出现在最终 SQL 输出中。）\n"
+    "\n"
+    "=============================\n"
+    "【最终输出要求】\n"
+    "=============================\n"
+    "输出仅包含一条完整的 MySQL SELECT 语句，不得附带任何解释、注释或分析性文字。"
+)
+
+
+@lru_cache(maxsize=128)
+def _qualify_pat(table: str) -> "re.Pattern[str]":
+    """匹配未被 `db`. 限定的 `table` 引用。"""
+    return re.compile(rf"(?<!`\.)`{re.escape(table)}`")
+
+
+def _sql_statement_end(text: str, start: int = 0) -> int:
+    """从 start 起返回第一个语句结束分号的位置（跳过字符串、反引号标识符与注释中的分号），没有则返回 -1。"""
+    i, n = start, len(text)
+    while i < n:
+        ch = text[i]
+        if ch in ("'", '"', "`"):
+            # 引号内容：支持反斜杠转义与重复引号转义
+            i += 1
+            while i < n:
+                c = text[i]
+                if c == "\\" and ch != "`":
+                    i += 2
+                    continue
+                if c == ch:
+                    if i + 1 < n and text[i + 1] == ch:
+                        i += 2
+                        continue
+                    break
+                i += 1
+        elif (ch == "-" and text.startswith("--", i)) or ch == "#":
+            nl = text.find("\n", i)
+            if nl == -1:
+                return -1
+            i = nl
+        elif ch == "/" and text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            if end == -1:
+                return -1
+            i = end + 1
+        elif ch == ";":
+            return i
+        i += 1
+    return -1
+
+
 class Nlp2SqlAgent(BaseAgent):
     """
     将自然语言转 SQL 的 Agent。
@@ -22,103 +151,125 @@ class Nlp2SqlAgent(BaseAgent):
         self.llm_assistant = kwargs.get("llm_assistant")
         self.max_preview_rows: int = int(kwargs.get("max_preview_rows", 20))
         self._logger = logging.getLogger(self.__class__.__name__)
-        # 存储最近一次规划/生成/执行的上下文，便于外部调试或记录
-        self.last_plan: List[str] | None = None
-        self.last_sql_sequence: List[str] | None = None
-        self.last_execution_results: List[Any] | None = None
-        self._last_step_context: List[Dict[str, Any]] | None = None
+        # 实例在多个请求线程间共享，规划/SQL 序列通过返回值传递，不保存在实例上
+        # 表结构 / distinct 探测结果缓存：{key: (写入时间, 结果)}，超过 schema_ttl 秒后重新获取
+        self.schema_ttl: float = float(kwargs.get("schema_ttl", 300))
+        self._schema_cache: Dict[Tuple[str, str], Tuple[float, Dict[str, Any]]] = {}
+        self._distinct_cache: Dict[Tuple[str, str, int], Tuple[float, Dict[str, Dict[str, Any]]]] = {}
+        self._cache_lock = threading.Lock()
+        # 不超过该长度且无复合语义的问题跳过子问题规划
+        self.plan_min_length: int = int(kwargs.get("plan_min_length", 30))
+        # 仅对低基数类型（enum/set/tinyint/短字符串）探测 distinct 值
+        self.distinct_max_char_length: int = int(kwargs.get("distinct_max_char_length", 64))
+        # 规范化问题 -> 已通过判别的 (规划, SQL 序列) 缓存，由 remember() 写入；命中时跳过 LLM 调用与数据库探测
+        self.sql_cache_size: int = int(kwargs.get("sql_cache_size", 1024))
+        self.sql_cache_ttl: float = float(kwargs.get("sql_cache_ttl", 600))
+        # 条目：(写入时间, 规划, SQL 序列, 调用方附带的判别结果)
+        self._sql_cache: "OrderedDict[Tuple[str, str, str], Tuple[float, Tuple[str, ...], Tuple[str, ...], Any]]" = OrderedDict()
 
     #流式输出结果获取处理
-    def _get_last_llm_output(self, assistant, messages, stream: bool = True) -> str:
-        sql_text = ""
-        DELIM = "\n<CHUNK_END>\n"
+    @staticmethod
+    def _extract_parts(chunk: Any) -> Iterator[str]:
+        """从单个流式 chunk 中提取文本片段，兼容 dict / str / list 及其他可迭代结构。"""
+        if isinstance(chunk, dict):
+            part = chunk.get("content", "") or chunk.get("reasoning_content", "")
+            if part:
+                yield part
+            return
+        if isinstance(chunk, str):
+            yield chunk
+            return
         try:
-            for chunk in assistant.run(messages=messages, stream=stream):
-                if isinstance(chunk, list):
-                    for item in chunk:
-                        if isinstance(item, dict):
-                            part = item.get("content", "") or item.get("reasoning_content", "")
-                            if part:
-                                sql_text += part + DELIM
-                        elif isinstance(item, str):
-                            sql_text += item + DELIM
-                elif isinstance(chunk, dict):
-                    part = chunk.get("content", "") or chunk.get("reasoning_content", "")
+            for item in chunk:
+                if isinstance(item, dict):
+                    part = item.get("content", "") or item.get("reasoning_content", "")
                     if part:
-                        sql_text += part + DELIM
-                elif isinstance(chunk, str):
-                    sql_text += chunk + DELIM
-                else:
-                    try:
-                        for item in chunk:
-                            if isinstance(item, dict):
-                                part = item.get("content", "") or item.get("reasoning_content", "")
-                                if part:
-                                    sql_text += part + DELIM
-                            elif isinstance(item, str):
-                                sql_text += item + DELIM
-                    except Exception:
-                        pass
-                # print("*"*30)
-                # print(chunk)
-
-            # 取最后一个非空 chunk 作为最终输出
-            if DELIM in sql_text:
-                parts = [p.strip() for p in sql_text.split(DELIM) if p.strip()]
-                result = parts[-1] if parts else ""
-            else:
-                result = sql_text.strip()
-            
+                        yield part
+                elif isinstance(item, str):
+                    yield item
+        except Exception:
+            return
+
+    # 流式 chunk 攒批阈值：数量或时间窗口任一达到即处理一批
+    _STREAM_BATCH_SIZE = 32
+    _STREAM_BATCH_INTERVAL = 0.05
+
+    def _iter_stream_text(self, assistant, messages, stream: bool = True) -> Iterator[str]:
+        """产出 assistant 流式输出中的文本片段。
+
+        chunk 先攒批再处理：调用方只关心最后一个非空片段，因此每批从最新的 chunk
+        向前查找，只对第一个含非空片段的 chunk 做解析，较早的 chunk 直接丢弃。
+        """
+        pending: List[Any] = []
+        last_flush = time.monotonic()
+        chunks = assistant.run(messages=messages, stream=stream)
+        try:
+            for chunk in chunks:
+                pending.append(chunk)
+                now = time.monotonic()
+                if len(pending) >= self._STREAM_BATCH_SIZE or now - last_flush >= self._STREAM_BATCH_INTERVAL:
+                    yield from self._flush_stream_batch(pending)
+                    pending = []
+                    last_flush = now
+            if pending:
+                yield from self._flush_stream_batch(pending)
+        finally:
+            # 调用方提前结束时同时关闭底层流，停止继续接收 token
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+
+    def _flush_stream_batch(self, pending: List[Any]) -> List[str]:
+        for chunk in reversed(pending):
+            parts = list(self._extract_parts(chunk))
+            if any(p.strip() for p in parts):
+                return parts
+        return []
+
+    @staticmethod
+    def _last_non_empty(pieces: Iterable[str]) -> str:
+        """单次遍历，返回最后一个非空片段（已 strip）。"""
+        last = ""
+        for piece in pieces:
+            stripped = piece.strip()
+            if stripped:
+                last = stripped
+        return last
+
+    def _get_last_llm_output(self, assistant, messages, stream: bool = True) -> str:
+        try:
+            # 取最后一个非空 chunk 作为最终输出；一旦得到完整的 SELECT 语句即提前结束流
+            result = ""
+            pieces = self._iter_stream_text(assistant, messages, stream=stream)
+            try:
+                for piece in pieces:
+                    stripped = piece.strip()
+                    if not stripped:
+                        continue
+                    result = stripped
+                    # 从匹配结束处开始扫描，跳过 ```sql 围栏，避免其反引号被当作未闭合的标识符
+                    m = self._SQL_START_RE.match(result)
+                    if m and _sql_statement_end(result, m.end()) != -1:
+                        break
+            finally:
+                pieces.close()
+
             # 如果包含分号，截取到最后一个分号（包含分号）
             if ";" in result:
                 idx = result.rfind(";")
                 result = result[: idx + 1].strip()
             return result
         
-        except Exception as e:
-            print(f"get_last_llm_output 错误: {e}")
+        except Exception:
+            self._logger.exception("get_last_llm_output 错误")
             return ""
 
     def _get_last_text_output(self, assistant, messages, stream: bool = True) -> str:
         """与 _get_last_llm_output 类似，但不做分号裁剪，适用于纯文本/NL 场景。"""
-        text = ""
-        DELIM = "\n<CHUNK_END>\n"
         try:
-            for chunk in assistant.run(messages=messages, stream=stream):
-                if isinstance(chunk, list):
-                    for item in chunk:
-                        if isinstance(item, dict):
-                            part = item.get("content", "") or item.get("reasoning_content", "")
-                            if part:
-                                text += part + DELIM
-                        elif isinstance(item, str):
-                            text += item + DELIM
-                elif isinstance(chunk, dict):
-                    part = chunk.get("content", "") or chunk.get("reasoning_content", "")
-                    if part:
-                        text += part + DELIM
-                elif isinstance(chunk, str):
-                    text += chunk + DELIM
-                else:
-                    try:
-                        for item in chunk:
-                            if isinstance(item, dict):
-                                part = item.get("content", "") or item.get("reasoning_content", "")
-                                if part:
-                                    text += part + DELIM
-                            elif isinstance(item, str):
-                                text += item + DELIM
-                    except Exception:
-                        pass
-
-            if DELIM in text:
-                parts = [p.strip() for p in text.split(DELIM) if p.strip()]
-                result = parts[-1] if parts else ""
-            else:
-                result = text.strip()
-            return result
-        except Exception as e:
-            print(f"get_last_text_output 错误: {e}")
+            return self._last_non_empty(self._iter_stream_text(assistant, messages, stream=stream))
+        except Exception:
+            self._logger.exception("get_last_text_output 错误")
             return ""
 
     def _normalize_rows(self, rows: Any, col_names: Optional[List[str]]) -> List[Dict[str, Any]]:
@@ -134,12 +285,9 @@ class Nlp2SqlAgent(BaseAgent):
                 # 使用列名映射
                 if not col_names:
                     # 没有列名，只能转为 idx: value
-                    for r in rows:
-                        out.append({str(i): v for i, v in enumerate(r)})
-                else:
-                    for r in rows:
-                        out.append({col_names[i]: r[i] for i in range(min(len(r), len(col_names)))})
-                return out
+                    return [{str(i): v for i, v in enumerate(r)} for r in rows]
+                # zip 自动按较短一方截断
+                return [dict(zip(col_names, r)) for r in rows]
         # 其他类型兜底
         for r in rows:
             try:
@@ -148,8 +296,98 @@ class Nlp2SqlAgent(BaseAgent):
                 out.append({"value": str(r)})
         return out
 
+    def _cache_get(self, cache: Dict[Any, Tuple[float, Any]], key: Any) -> Any:
+        with self._cache_lock:
+            entry = cache.get(key)
+            if entry is None:
+                return None
+            ts, value = entry
+            if time.monotonic() - ts >= self.schema_ttl:
+                cache.pop(key, None)
+                return None
+            return value
+
+    def _cache_put(self, cache: Dict[Any, Tuple[float, Any]], key: Any, value: Any) -> None:
+        with self._cache_lock:
+            cache[key] = (time.monotonic(), value)
+
+    def invalidate(self, database: str, table: str) -> None:
+        """清除指定表的结构、distinct 与 SQL 缓存（表结构变更后调用）。"""
+        with self._cache_lock:
+            self._schema_cache.pop((database, table), None)
+            for key in [k for k in self._distinct_cache if k[:2] == (database, table)]:
+                self._distinct_cache.pop(key, None)
+            for key in [k for k in self._sql_cache if k[:2] == (database, table)]:
+                self._sql_cache.pop(key, None)
+
+    _SQL_START_RE = re.compile(r"(?:```(?:sql)?\s*)?(?:select|with)\b", re.IGNORECASE)
+    _CANON_SPACE_RE = re.compile(r"\s+")
+    _SQL_KW_RE = re.compile(r"\b(?:select|insert|update|delete|create|drop)\s", re.IGNORECASE)
+
+    @classmethod
+    def _canonicalize(cls, user_nl: str) -> str:
+        """问题规范化：全半角统一、小写、合并空白。
+        运算符、正负号与小数点会改变查询语义（如 > 与 <），必须保留。
+        """
+        text = unicodedata.normalize("NFKC", user_nl or "").lower()
+        return cls._CANON_SPACE_RE.sub(" ", text).strip()
+
+    def _sql_cache_key(self, user_nl: str, database: str, table: str) -> Tuple[str, str, str]:
+        digest = hashlib.blake2b(self._canonicalize(user_nl).encode("utf-8"), digest_size=16).hexdigest()
+        return database, table, digest
+
+    def _sql_cache_entry(self, key: Tuple[str, str, str]) -> Tuple[float, Tuple[str, ...], Tuple[str, ...], Any] | None:
+        with self._cache_lock:
+            entry = self._sql_cache.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] >= self.sql_cache_ttl:
+                self._sql_cache.pop(key, None)
+                return None
+            self._sql_cache.move_to_end(key)
+            return entry
+
+    def _sql_cache_get(self, key: Tuple[str, str, str]) -> Tuple[List[str], List[str]] | None:
+        entry = self._sql_cache_entry(key)
+        if entry is None:
+            return None
+        return list(entry[1]), list(entry[2])
+
+    def _sql_cache_put(self, key: Tuple[str, str, str], plan: List[str], sql_sequence: List[str], result: Any = None) -> None:
+        with self._cache_lock:
+            self._sql_cache[key] = (time.monotonic(), tuple(plan), tuple(sql_sequence), result)
+            self._sql_cache.move_to_end(key)
+            while len(self._sql_cache) > self.sql_cache_size:
+                self._sql_cache.popitem(last=False)
+
+    def remember(self, user_nl: str, database: str, table: str, plan: List[str], sql_sequence: List[str], result: Any = None) -> None:
+        """缓存已通过判别的规划与 SQL 序列；之后同一问题的首轮生成直接复用。
+        result 为调用方附带的判别结果，可由 recall() 取回，与 SQL 共用同一键、TTL 与 invalidate()。
+        """
+        if not user_nl or not sql_sequence or not sql_sequence[-1]:
+            return
+        self._sql_cache_put(self._sql_cache_key(user_nl, database, table), plan, sql_sequence, result)
+
+    def recall(self, user_nl: str, database: str, table: str) -> Any:
+        """取回 remember() 时附带的判别结果；未命中、已过期或未附带时返回 None。"""
+        if not user_nl:
+            return None
+        entry = self._sql_cache_entry(self._sql_cache_key(user_nl, database, table))
+        return entry[3] if entry is not None else None
+
     def _fetch_schema(self, conn: Any, database: str, table: str) -> Dict[str, Any]:
-        """获取表结构信息"""
+        """获取表结构信息（按 (database, table) 缓存）"""
+        key = (database, table)
+        cached = self._cache_get(self._schema_cache, key)
+        if cached is not None:
+            return cached
+        schema = self._load_schema(conn, database, table)
+        # 空结构通常意味着查询失败，不缓存
+        if schema["columns"]:
+            self._cache_put(self._schema_cache, key, schema)
+        return schema
+
+    def _load_schema(self, conn: Any, database: str, table: str) -> Dict[str, Any]:
         sql = f"SHOW FULL COLUMNS FROM `{database}`.`{table}`;"
         rows = conn.execute_query(sql)
         col_names = None
@@ -159,14 +397,24 @@ class Nlp2SqlAgent(BaseAgent):
             pass
         items = self._normalize_rows(rows, col_names)
         cols: List[Dict[str, Any]] = []
+        if not items:
+            return {"database": database, "table": table, "columns": cols}
+        # 各行键名一致：根据首行一次性解析出每个逻辑字段对应的实际键名
+        norm = {str(k).lower(): k for k in items[0]}
+        name_key = norm.get("field") or norm.get("column_name")
+        type_key = norm.get("type") or norm.get("column_type")
+        null_key = norm.get("null") or norm.get("is_nullable")
+        pk_key = norm.get("key") or norm.get("column_key")
+        default_key = norm.get("default") or norm.get("column_default")
+        comment_key = norm.get("comment") or norm.get("column_comment")
         for it in items:
             cols.append({
-                "name": it.get("Field") or it.get("COLUMN_NAME") or it.get("field") or it.get("column_name") or "",
-                "type": it.get("Type") or it.get("COLUMN_TYPE") or it.get("type") or it.get("column_type") or "",
-                "nullable": (it.get("Null") or it.get("IS_NULLABLE") or "").upper() in ("YES", "Y", "TRUE"),
-                "key": it.get("Key") or it.get("COLUMN_KEY") or "",
-                "default": it.get("Default") if "Default" in it or "default" in it else None,
-                "comment": it.get("Comment") or it.get("COLUMN_COMMENT") or "",
+                "name": (it[name_key] if name_key else "") or "",
+                "type": (it[type_key] if type_key else "") or "",
+                "nullable": str((it[null_key] if null_key else "") or "").upper() in _YES,
+                "key": (it[pk_key] if pk_key else "") or "",
+                "default": it[default_key] if default_key else None,
+                "comment": (it[comment_key] if comment_key else "") or "",
             })
         return {
             "database": database,
@@ -174,11 +422,83 @@ class Nlp2SqlAgent(BaseAgent):
             "columns": [c for c in cols if c["name"]],
         }
 
+    _COLUMN_TYPE_RE = re.compile(r"^\s*(\w+)\s*(?:\(\s*(\d+)\s*\))?")
+    _DISTINCT_TYPES = frozenset({"enum", "set", "tinyint"})
+    _DISTINCT_CHAR_TYPES = frozenset({"char", "varchar"})
+
+    def _distinct_candidates(self, columns: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """按 SHOW FULL COLUMNS 已返回的列类型筛选值得探测 distinct 的字段。
+
+        长文本、时间、浮点等字段几乎不会是有约束的枚举值，探测它们只会增加查询开销。
+        """
+        out: List[Dict[str, Any]] = []
+        for col in columns:
+            m = self._COLUMN_TYPE_RE.match(str(col.get("type") or ""))
+            if not m:
+                continue
+            base = m.group(1).lower()
+            if base in self._DISTINCT_TYPES:
+                out.append(col)
+            elif base in self._DISTINCT_CHAR_TYPES:
+                length = m.group(2)
+                if length is None or int(length) <= self.distinct_max_char_length:
+                    out.append(col)
+        return out
+
     def _fetch_column_distincts(self, conn: Any, database: str, table: str, columns: List[Dict[str, Any]], limit: int = 10) -> Dict[str, Dict[str, Any]]:
+        """获取各字段 distinct 值（按 (database, table, limit) 缓存）"""
+        key = (database, table, limit)
+        cached = self._cache_get(self._distinct_cache, key)
+        if cached is not None:
+            return cached
+        result = self._load_column_distincts(conn, database, table, columns, limit=limit)
+        if result:
+            self._cache_put(self._distinct_cache, key, result)
+        return result
+
+    def _load_column_distincts(self, conn: Any, database: str, table: str, columns: List[Dict[str, Any]], limit: int = 10) -> Dict[str, Dict[str, Any]]:
         """
         对每个字段，获取前limit个distinct值，并判断是否有约束。
         返回: {col: {"distinct": [...], "constrained": bool}}
+
+        所有字段合并为一条 UNION ALL 查询，只需一次数据库往返；
+        合并查询失败时回退为逐列探测，保证单列异常不影响其他字段。
         """
+        if not columns:
+            return {}
+        # 以列序号作为 _col 标识，避免在字符串字面量中转义列名
+        selects = [
+            f"SELECT {idx} AS _col, CAST(`{col['name']}` AS CHAR) AS _v FROM "
+            f"(SELECT DISTINCT `{col['name']}` FROM `{database}`.`{table}` WHERE `{col['name']}` IS NOT NULL LIMIT {limit+1}) t{idx}"
+            for idx, col in enumerate(columns)
+        ]
+        sql = " UNION ALL ".join(selects) + ";"
+        try:
+            rows = conn.execute_query(sql)
+        except Exception:
+            rows = None
+        if rows is None:
+            return self._fetch_column_distincts_serial(conn, database, table, columns, limit=limit)
+
+        buckets: List[List[Any]] = [[] for _ in columns]
+        for r in rows:
+            if isinstance(r, dict):
+                idx, val = r.get("_col"), r.get("_v")
+            elif isinstance(r, (list, tuple)) and len(r) >= 2:
+                idx, val = r[0], r[1]
+            else:
+                continue
+            try:
+                buckets[int(idx)].append(val)
+            except (TypeError, ValueError, IndexError):
+                continue
+        result = {}
+        for col, vals in zip(columns, buckets):
+            result[col["name"]] = {"distinct": vals[:limit], "constrained": len(vals) <= limit}
+        return result
+
+    def _fetch_column_distincts_serial(self, conn: Any, database: str, table: str, columns: List[Dict[str, Any]], limit: int = 10) -> Dict[str, Dict[str, Any]]:
+        """逐列探测 distinct 值（合并查询失败时的回退路径）。"""
         result = {}
         for col in columns:
             colname = col["name"]
@@ -197,102 +517,40 @@ class Nlp2SqlAgent(BaseAgent):
                 result[colname] = {"distinct": [], "constrained": False}
         return result
 
-    def _build_system_prompt(self) -> str:
-        system_prompt = (
-                "你是一个资深的 SQL 助手，擅长将用户的自然语言问题精确地转换为 MySQL 查询语句。\n"
-                "\n"
-                "=============================\n"
-                "【输出要求】\n"
-                "=============================\n"
-                "1) 仅输出一条 SQL 语句，必须以 SELECT 开头，并以分号结尾；禁止输出任何解释、注释或多余文本。\n"
-                "2) 输出语句严格符合MySQL语法\n"
-                "3) 对齐已知的数据库/表/列名，禁止使用不存在的字段。\n"
-                "4) 标识符统一使用反引号包裹，如 `db`.`table`、`col`。\n"
-                "\n"
-                "=============================\n"
-                "【通用生成规则】\n"
-                "=============================\n"
-                "1) LIMIT 安全：禁止无限制查询；若用户未指定返回条数，统一追加 LIMIT 1000。\n"
-                "2) 聚合与分组：\n"
-                "   - 若查询涉及聚合（SUM/AVG/COUNT）且用户语义含“各/各个/按/每个/分别/不同/每家”等词，必须包含 GROUP BY。\n"
-                "   - SELECT 中必须同时输出分组字段与聚合字段。\n"
-                "3) 精度与取整：\n"
-                "   - AVG、SUM、比例类字段默认使用 ROUND(..., 2)。\n"
-                "4) 空值健壮性：\n"
-                "   - 对空值使用 COALESCE()/IFNULL()，除法时用 NULLIF(分母, 0)。\n"
-                "5) 时间计算：\n"
-                "   - 时间计算规则（TIMESTAMPDIFF / DATEDIFF）：在计算工龄、住院天数、使用时长等时间区间时，必须使用 TIMESTAMPDIFF() 或 DATEDIFF()。"
-                "   对结束日期为空的情况，不得一律替换为 CURDATE()；需遵循以下逻辑："
-                "   - 若空值表示“仍在进行中”（如 leave_date、discharge_date、usage_end），或 status ∈ ('active','in_progress','ongoing')，则可用 CURDATE() 替代。"
-                "   - 若空值仅表示“数据缺失”“尚未录入”或属于历史快照记录，则不可使用 CURDATE()，应保留 NULL 或过滤掉。\n"
-                "6) 排序与排名：\n"
-                "   - “最高/最大/Top/前N/排名前” → ORDER BY 指标 DESC；“最低/最小/后N” → ASC。\n"
-                "   - “每个X中最高/最大” 表示分组内极值，必须使用窗口函数或子查询。\n"
-                "   - 如果存在相同指标值导致并列排名，应全部返回，即需要通过比较最大/最小值回溯所有并列记录（如使用子查询或 WHERE 指标 = 全局最大值）。不能只取固定 N 条。  \n"
-                "7) 字段选择：尽量明确列出所需字段，禁止 SELECT *。\n"
-                "8) 聚合过滤：聚合后条件使用 HAVING，行级过滤使用 WHERE。\n"
-                "9) 时间序列：出现“按日/周/月/季度/年/趋势”时，应显式输出时间字段并设聚合粒度。\n"
-                "10) 比例与占比：出现“占比/比例/份额/贡献度”时，使用 (分子 / NULLIF(分母, 0)) * 100 并 ROUND(..., 2)。\n"
-                "\n"
-                "=============================\n"
-                "【高级逻辑与歧义消解 (A-G)】\n"
-                "=============================\n"
-                "A) 分组意图判定：\n"
-                "   - 若自然语言包含“各/各个/每个/每家/每类/按/分/分别/不同”等词，表示要对分组聚合；SQL 必须包含 GROUP BY。\n"
-                "   - 若问题中出现“...中...最高.../...中...最低.../...中...最大...”类似的结构   ，必须理解为“每组内取极值”的问题，SQL 需使用窗口函数（ROW_NUMBER/RANK）或子查询 + MAX/MIN 聚合方式取组内第一。\n"
-                "\n"
-                "B) 同义歧义归一：\n"
-                "   - “每个”“各个”“各”“每家”“不同”“分别”“按X分”语义相同 → 都表示分组。\n"
-                "   - “中最高/中最小”语义 ≠ “最高/最小”；前者是组内极值，后者是全局极值。\n"
-                "   - “每个医院中最高” → 按医院分组取平均工资最高的记录。\n"
-                "   - “各个医院中最高” → 与上同义，不得误判为全局排序。\n"
-                "\n"
-                "C) 极值判断与SQL生成：\n"
-                "   - 若语义为“每组内取最大/最小”→ 必须生成：\n"
-                "       ① 使用窗口函数 ROW_NUMBER()/RANK() OVER(PARTITION BY group_field ORDER BY metric DESC/ASC) + 外层 WHERE rank=1；或\n"
-                "       ② 使用双层子查询 + MAX()/MIN() 匹配方案。\n"
-                "   - 若语义为“全局最大/最小”→ 仅使用 ORDER BY + LIMIT 1。\n"
-                "\n"
-                "D) 时间与趋势分析：\n"
-                "   - “按日/月/年/趋势” → 时间字段需聚合或分组。\n"
-                "   - “近N天/去年/本月” → 构造时间过滤条件。\n"
-                "\n"
-                "E) 数值精度与比例：\n"
-                "   - 保留两位小数 (ROUND(...,2))，防止精度丢失。\n"
-                "\n"
-                "F) 状态与否定语义：\n"
-                "   - “尚未/未/没有” → IS NULL 或 =0；“已/存在” → IS NOT NULL 或 >0；“进行中” → start_date <= CURDATE() AND (end_date IS NULL OR end_date >= CURDATE())。\n"
-                "\n"
-                "G) 窗口函数触发逻辑：\n"
-                "   - 若句子包含“每个X中最高/最大/最小/TopN”等结构，必须优先考虑使用窗口函数（ROW_NUMBER/RANK/DENSE_RANK）进行分组排名。\n"
-                "   - 若 MySQL 版本支持窗口函数（≥8.0），优先使用窗口函数；否则使用子查询 + 聚合替代。\n"
-                "\n"
-                "（以上 A-G 七项仅用于模型内部推理，不得出现在最终 SQL 输出中。）\n"
-                "\n"
-                "=============================\n"
-                "【最终输出要求】\n"
-                "=============================\n"
-                "输出仅包含一条完整的 MySQL SELECT 语句，不得附带任何解释、注释或分析性文字。"
-            )
-
-        return system_prompt
-
+    def _format_schema(self, schema: Dict[str, Any]) -> str:
+        """紧凑的表结构文本：每列一行 `name` TYPE [PK] [NOT NULL] [DEFAULT x] [-- comment]。"""
+        lines = [f"Table `{schema['database']}`.`{schema['table']}`:"]
+        for c in schema["columns"]:
+            line = f"  `{c['name']}` {c['type']}"
+            if c.get("key") == "PRI":
+                line += " PK"
+            if not c.get("nullable"):
+                line += " NOT NULL"
+            if c.get("default") is not None:
+                line += f" DEFAULT {c['default']}"
+            if c.get("comment"):
+                line += f"  -- {c['comment']}"
+            lines.append(line)
+        return "\n".join(lines)
 
     def _build_user_prompt(self, user_nl: str, schema: Dict[str, Any], col_distincts: Dict[str, Dict[str, Any]], fix_suggestion: str | None = None) -> str:
-        schema_text = json.dumps(schema, ensure_ascii=False, indent=2, default=str)
+        schema_text = self._format_schema(schema)
         # 拼接每个字段的distinct信息
-        distinct_lines = []
+        distinct_lines: List[str] = []
+        append = distinct_lines.append
+        cd_get = col_distincts.get
         for col in schema["columns"]:
-            name = col["name"]
-            d = col_distincts.get(name, {})
-            vals = d.get("distinct", [])
-            constrained = d.get("constrained", False)
-            if vals:
-                val_str = ", ".join([str(v) for v in vals])
-                if constrained:
-                    distinct_lines.append(f"字段 `{name}` 约束值: {val_str} (仅可选其一)")
-                else:
-                    distinct_lines.append(f"字段 `{name}` 前10个不同值: {val_str} (内容无约束)")
+            d = cd_get(col["name"])
+            if not d:
+                continue
+            vals = d["distinct"]
+            if not vals:
+                continue
+            val_str = ", ".join(map(str, vals))
+            if d["constrained"]:
+                append(f"字段 `{col['name']}` 约束值: {val_str} (仅可选其一)")
+            else:
+                append(f"字段 `{col['name']}` 前10个不同值: {val_str} (内容无约束)")
         distinct_text = "\n".join(distinct_lines)
         extra = ""
         if fix_suggestion:
@@ -321,17 +579,32 @@ class Nlp2SqlAgent(BaseAgent):
         #     sql = sql[:-1] + " LIMIT 1000;"
 
         # 确保引用目标表（尽量避免被 LLM 换表），若未包含库名，则补齐
-        target = f"`{database}`.`{table}`"
-        if f"`{table}`" in sql and f"`{database}`.`{table}`" not in sql:
-            sql = sql.replace(f"`{table}`", target)
+        # 仅替换未带库名前缀的 `table`，已限定的引用保持不变
+        sql = _qualify_pat(table).sub(lambda _m: f"`{database}`.`{table}`", sql)
 
         return sql
     
+    # 复合/嵌套语义的提示词：出现任一即交给 LLM 规划
+    _PLAN_MARKERS = (
+        "各", "每", "最", "并且", "而且", "以及", "同时", "然后", "之后", "之前", "再",
+        "分别", "对比", "比较", "相比", "占比", "比例", "其中",
+    )
+    _PLAN_SEPARATOR_RE = re.compile(r"[，,；;。？?！!]")
+
+    def _needs_planning(self, user_nl: str) -> bool:
+        """简短且无复合语义的问题直接生成 SQL，省去一次规划 LLM 调用。"""
+        text = user_nl.strip().rstrip("。？?！!")
+        if len(text) > self.plan_min_length:
+            return True
+        if self._PLAN_SEPARATOR_RE.search(text):
+            return True
+        return any(marker in text for marker in self._PLAN_MARKERS)
+
     def _plan_subqueries(self, user_nl: str) -> List[str]:
         """判断是否需要拆解为子问题，返回子问题列表。"""
         if not user_nl:
             return []
-        if self.llm_assistant is None:
+        if self.llm_assistant is None or not self._needs_planning(user_nl):
             return [user_nl]
         system_prompt = (
             "你是一名SQL问题规划专家。\n"
@@ -352,6 +625,7 @@ class Nlp2SqlAgent(BaseAgent):
             {"role": "user", "content": user_prompt},
         ]
         raw = self._get_last_text_output(self.llm_assistant, messages, stream=True)
+        self._logger.debug("plan_subqueries raw=%s", raw)
         text = (raw or "").strip()
         if text.startswith("```") and text.endswith("```"):
             text = text.strip("`")
@@ -364,6 +638,9 @@ class Nlp2SqlAgent(BaseAgent):
             else:
                 cleaned = []
             need_split = bool(data.get("need_split"))
+            # 规划模型直接输出了 SQL 而非自然语言子问题时，回退原问题
+            if any(self._SQL_KW_RE.search(q) for q in cleaned):
+                return [user_nl]
             if cleaned:
                 if need_split and len(cleaned) >= 2:
                     return cleaned
@@ -393,6 +670,40 @@ class Nlp2SqlAgent(BaseAgent):
             sql = sql["content"]
         return self._postprocess_sql(sql, database, table)
 
+    def generate(
+        self,
+        user_nl: str,
+        database: str,
+        table: str,
+        conn: Any,
+        fix_suggestion: str | None = None,
+    ) -> Tuple[List[str], List[str]]:
+        """规划子问题并逐个生成 SQL，返回 (plan, sql_sequence)。"""
+        if not user_nl or not database or not table or conn is None:
+            return [], []
+
+        # 带修复建议的重生成必须重新调用 LLM，只有首轮生成查缓存
+        cached = None if fix_suggestion else self._sql_cache_get(self._sql_cache_key(user_nl, database, table))
+        if cached is not None:
+            return cached
+
+        plan = self._plan_subqueries(user_nl)
+        if not plan:
+            plan = [user_nl]
+
+        schema = self._fetch_schema(conn, database, table)
+        candidates = self._distinct_candidates(schema["columns"])
+        col_distincts = self._fetch_column_distincts(conn, database, table, candidates, limit=10)
+        system_prompt = _SYSTEM_PROMPT
+
+        sql_sequence = []
+        for idx, sub_query in enumerate(plan):
+            fix = fix_suggestion if idx == len(plan) - 1 else None
+            sql_sequence.append(
+                self._generate_sql_for_query(sub_query, database, table, schema, col_distincts, system_prompt, fix_suggestion=fix)
+            )
+        return plan, sql_sequence
+
     def run(
         self,
         user_nl: str,
@@ -411,34 +722,17 @@ class Nlp2SqlAgent(BaseAgent):
         if not user_nl or not database or not table or conn is None:
             return "" if not execute else {"plan": [], "sql_sequence": [], "results": [], "final_result": None}
 
-        plan = self._plan_subqueries(user_nl)
-        if not plan:
-            plan = [user_nl]
-
-        schema = self._fetch_schema(conn, database, table)
-        col_distincts = self._fetch_column_distincts(conn, database, table, schema["columns"], limit=10)
-        system_prompt = self._build_system_prompt()
-
-        sql_sequence: List[str] = []
-        execution_results: List[Any] = []
+        plan, sql_sequence = self.generate(user_nl, database, table, conn, fix_suggestion=fix_suggestion)
 
-        for idx, sub_query in enumerate(plan):
-            fix = fix_suggestion if idx == len(plan) - 1 else None
-            sql = self._generate_sql_for_query(sub_query, database, table, schema, col_distincts, system_prompt, fix_suggestion=fix)
-            sql_sequence.append(sql)
-            if execute:
+        if execute:
+            execution_results: List[Any] = []
+            for sql in sql_sequence:
                 try:
                     result = conn.execute_query(sql)
                 except Exception as exc:  # pragma: no cover - 数据库异常容错
                     self._logger.warning("执行 SQL 失败: %s", exc)
                     result = None
                 execution_results.append(result)
-
-        self.last_plan = plan
-        self.last_sql_sequence = sql_sequence
-        self.last_execution_results = execution_results if execute else None
-
-        if execute:
             final_result = execution_results[-1] if execution_results else None
             return {
                 "plan": plan,
@@ -447,4 +741,4 @@ class Nlp2SqlAgent(BaseAgent):
                 "final_result": final_result,
             }
 
-        return sql_sequence[-1] if sql_sequence else ""
\ No newline at end of file
+        return sql_sequence[-1] if sql_sequence else ""
@@ -192,9 +192,13 @@ function renderTable(result) {
   table.appendChild(thead);
 
   const tbody = document.createElement('tbody');
-  for (const row of result.rows || []) {
+  // 列式数据：data[j][i] 为第 j 列第 i 行
+  const data = result.data || [];
+  const rowCount = data.length ? data[0].length : 0;
+  for (let i = 0; i < rowCount; i++) {
     const tr = document.createElement('tr');
-    for (const cell of row) {
+    for (const col of data) {
+      const cell = col[i];
       const td = document.createElement('td');
       td.textContent = cell === null || cell === undefined ? '' : String(cell);
       tr.appendChild(td);
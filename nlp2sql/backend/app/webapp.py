@@ -12,97 +12,130 @@ Flask 前端：以可视化方式展示 main() 的运行流程
 运行：
   export FLASK_APP=nlp2sql.backend.app.webapp
   flask run -h 0.0.0.0 -p 5000
-或者：
+或者（已安装 gunicorn 时以 gthread 多线程方式运行，否则回退到开发服务器）：
   python -m nlp2sql.backend.app.webapp
 """
 from __future__ import annotations
 from pathlib import Path
+import functools
 import sys
 import json
-from decimal import Decimal
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional
 import re
 
 import pandas as pd
-from flask import Flask, render_template, jsonify, request
+from pandas.api.types import infer_dtype
+from flask import Flask, Response, render_template, jsonify, request
+
+try:
+    import pyarrow as pa
+except Exception:  # pragma: no cover - 可选依赖
+    pa = None
+
+try:
+    import orjson
+except Exception:  # pragma: no cover - 可选依赖
+    orjson = None
+
+try:
+    from sqlglot import exp, parse_one
+except Exception:  # pragma: no cover - 可选依赖
+    exp = None  # type: ignore
+    parse_one = None
 
 # 让 backend 包可以被正确导入
 ROOT = Path(__file__).resolve().parents[1]
 sys.path.insert(0, str(ROOT))
 
-from config.sql.sql import create_db  # noqa: E402
+from config.sql.sql import acquire_db, release_db  # noqa: E402
 from config.llm.llm import create_llm  # noqa: E402
 
 
 def rows_to_list(rows) -> list[str]:
-    out = []
+    """取元组行的第一列（SHOW DATABASES / SHOW TABLES）。"""
     if not rows:
-        return out
-    for r in rows:
-        try:
-            if isinstance(r, dict):
-                vals = list(r.values())
-                out.append(str(vals[0]) if vals else str(r))
-            elif isinstance(r, (list, tuple)):
-                out.append(str(r[0]) if r else str(r))
-            else:
-                out.append(str(r))
-        except Exception:
-            out.append(str(r))
-    return out
+        return []
+    return [str(r[0]) if r else str(r) for r in rows]
 
 
 def _coerce_decimal_to_float(df: pd.DataFrame) -> pd.DataFrame:
     """将 Decimal/decimal 列转换为 float64，避免被当作 object。"""
     try:
-        # 1) 处理 pyarrow decimal 扩展类型
-        for col in df.columns:
-            dt_str = str(df[col].dtype).lower()
-            if "decimal" in dt_str:
+        # 按位置访问列，列名重复（如 SELECT a, a）时也能逐列转换
+        for i in range(df.shape[1]):
+            s = df.iloc[:, i]
+            # 1) pyarrow decimal 扩展类型：Arrow 内部直接转换
+            if pa is not None and isinstance(s.dtype, pd.ArrowDtype) and pa.types.is_decimal(s.dtype.pyarrow_dtype):
                 try:
-                    df[col] = df[col].astype("float64[pyarrow]")
+                    df.isetitem(i, s.astype("float64[pyarrow]"))
                 except Exception:
                     try:
-                        df[col] = df[col].astype("float64")
+                        df.isetitem(i, s.astype("float64"))
                     except Exception:
                         pass
-
-        # 2) 处理 object 列中含有 Decimal 的情况
-        for col in df.columns:
-            s = df[col]
-            if s.dtype == object:
-                sample = s.dropna()
-                has_decimal = any(isinstance(v, Decimal) for v in sample.head(1000))
-                if has_decimal:
-                    s2 = s.apply(lambda v: float(v) if isinstance(v, Decimal) else (None if v is None else v))
-                    df[col] = pd.to_numeric(s2, errors='coerce')
+            # 2) object 列中含有 Decimal：一次类型推断 + 向量化转换
+            #    to_numeric 的拆箱循环在 Cython 中完成，Decimal 无法进入 Numba 等 JIT，无需再引入额外依赖
+            elif s.dtype == object and infer_dtype(s, skipna=True) == "decimal":
+                df.isetitem(i, pd.to_numeric(s, errors="coerce"))
     except Exception:
         return df
     return df
 
 
-def results_to_dataframe(results, columns=None) -> pd.DataFrame:
+def _arrow_dataframe(results, columns=None) -> Optional[pd.DataFrame]:
+    """结果行直接构建 Arrow Table 再转 pandas，跳过 NumPy object 中间结果；失败返回 None。
+    支持字典行，或元组行 + columns。
+    列名重复时 to_pandas 会把数值列转成字符串，此时返回 None 走 pandas 路径。
+    """
+    if pa is None or not results:
+        return None
+    if columns is not None and len(set(columns)) != len(columns):
+        return None
     try:
-        import pyarrow  # noqa: F401
-        df = pd.DataFrame(results, columns=columns, dtype_backend="pyarrow")
-        return _coerce_decimal_to_float(df)
+        if isinstance(results[0], dict):
+            tbl = pa.Table.from_pylist(results)
+            if columns is not None:
+                tbl = tbl.select(list(columns))
+        elif columns is not None:
+            # 元组行按列转置后逐列建 Arrow 数组
+            tbl = pa.Table.from_arrays([pa.array(col) for col in zip(*results)], names=list(columns))
+        else:
+            return None
+        # decimal 列在 Arrow 内直接转 float64
+        for i, field in enumerate(tbl.schema):
+            if pa.types.is_decimal(field.type):
+                tbl = tbl.set_column(i, field.name, tbl.column(i).cast(pa.float64()))
+        return tbl.to_pandas(types_mapper=pd.ArrowDtype, self_destruct=True, split_blocks=True)
     except Exception:
-        df = pd.DataFrame(results, columns=columns)
-        try:
-            df = df.convert_dtypes()
-        except Exception:
-            pass
-        return _coerce_decimal_to_float(df)
+        return None
+
+
+def results_to_dataframe(results, columns=None) -> pd.DataFrame:
+    df = _arrow_dataframe(results, columns)
+    if df is not None:
+        return df
+    # 不再 convert_dtypes：预览只需 Decimal -> float 这一种类型提升
+    df = pd.DataFrame(results, columns=columns)
+    return _coerce_decimal_to_float(df)
 
 
 def df_to_records(df: pd.DataFrame) -> Dict[str, Any]:
-    """将 DataFrame 转为前端友好格式。
-    返回：{ columns: [..], rows: [[..], ..] }
+    """将 DataFrame 转为前端友好的列式格式。
+    返回：{ columns: [..], data: [[第1列的值..], [第2列的值..], ..] }，data 与 columns 按位置对应
     """
     cols = [str(c) for c in df.columns]
-    rows = df.astype(object).where(pd.notnull(df), None).values.tolist()
-    return {"columns": cols, "rows": rows}
+    # 逐列整体转换，缺失值（NaN/NA/NaT）按 isna() 掩码替换为 None；to_numpy(na_value=None) 不会替换 datetime64 的 NaT
+    data = []
+    for i in range(df.shape[1]):
+        s = df.iloc[:, i]
+        data.append(s.astype(object).where(s.notna(), None).tolist())
+    return {"columns": cols, "data": data}
+
+
+_FENCE_RE = re.compile(r"^```(?:sql)?\s*\n([\s\S]*?)\n```\s*$", re.IGNORECASE)
 
 
 def normalize_sql(generated: Any) -> str:
@@ -127,83 +160,207 @@ def normalize_sql(generated: Any) -> str:
 
     s = generated.strip()
     # 去除 ```sql ... ``` 或 ``` 包裹
-    fence = re.compile(r"^```(?:sql)?\s*\n([\s\S]*?)\n```\s*$", re.IGNORECASE)
-    m = fence.match(s)
+    m = _FENCE_RE.match(s)
     if m:
         s = m.group(1).strip()
     # 去掉多余分号之外的内容（保留末尾分号可选）
     return s
 
 
+# 预览/分析默认只取前 N 行；需要完整结果时由前端显式传 full=true
+PREVIEW_ROW_LIMIT = 1000
+
+
+def ensure_limit(sql: str, default: int = PREVIEW_ROW_LIMIT) -> str:
+    """对没有 LIMIT 的查询语句补上 LIMIT，在数据库侧限制返回行数。
+    sqlglot 只用于判断最外层是否缺少 LIMIT；LIMIT 直接追加在原文末尾，执行的仍是判别/用户编辑过的原始文本。
+    解析失败、非查询语句、已有 LIMIT 或带锁定子句时原样返回。
+    """
+    if parse_one is None or not sql:
+        return sql
+    try:
+        tree = parse_one(sql, dialect="mysql")
+        if not isinstance(tree, (exp.Select, exp.Union)) or tree.args.get("limit"):
+            return sql
+        # FOR UPDATE / LOCK IN SHARE MODE 必须位于 LIMIT 之后，末尾追加会产生非法语句，原样返回
+        if tree.find(exp.Lock) is not None:
+            return sql
+    except Exception:
+        return sql
+    body = sql.rstrip().rstrip(";").rstrip()
+    # 换行分隔，避免原文以行注释结尾时吞掉追加的 LIMIT
+    return f"{body}\nLIMIT {default}"
+
+
 app = Flask(__name__, template_folder="templates", static_folder="static")
 
-# --- 全局缓存，避免每次请求都创建 LLM/Agent 导致等待时间长 ---
-LLM_SINGLETON = None
-TEXT2SQL_SINGLETON = None
-ANALYSIS_SINGLETON = None
-SQL_JUDGE_SINGLETON = None
 
+def jresp(obj: Any, status: int = 200, headers: Optional[Dict[str, str]] = None) -> Response:
+    """JSON 响应：优先使用 orjson（原生支持 numpy 标量/数组），未安装时回退到 jsonify。"""
+    if orjson is None:
+        resp = jsonify(obj)
+        resp.status_code = status
+    else:
+        body = orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS, default=str)
+        resp = Response(body, status=status, mimetype="application/json")
+    if headers:
+        resp.headers.update(headers)
+    return resp
+
+# --- 库/表目录缓存：目录变化频率很低，短 TTL 即可避免重复访问 MySQL ---
+_CATALOG_TTL = 30.0
+_CATALOG_CACHE: Dict[tuple, tuple] = {}
+_CATALOG_LOCK = threading.Lock()
+
+
+def _catalog_get(key: tuple) -> Optional[List[str]]:
+    with _CATALOG_LOCK:
+        hit = _CATALOG_CACHE.get(key)
+    if hit and time.monotonic() - hit[0] < _CATALOG_TTL:
+        return hit[1]
+    return None
+
+
+def _catalog_put(key: tuple, names: List[str]) -> None:
+    with _CATALOG_LOCK:
+        if len(_CATALOG_CACHE) >= 1024:
+            _CATALOG_CACHE.clear()
+        _CATALOG_CACHE[key] = (time.monotonic(), names)
+
+
+# --- 全局单例，避免每次请求都创建 LLM/Agent 导致等待时间长 ---
+# functools.cache 本身不能阻止并发首次调用时重复构建，这里额外加一把可重入锁
+_SINGLETON_LOCK = threading.RLock()
 
 
+def _singleton(factory):
+    cached = functools.cache(factory)
 
+    @functools.wraps(factory)
+    def wrapper():
+        with _SINGLETON_LOCK:
+            return cached()
+    return wrapper
 
+
+@_singleton
 def get_llm():
-    global LLM_SINGLETON
-    if LLM_SINGLETON is None:
-        LLM_SINGLETON = create_llm()
-    return LLM_SINGLETON
+    return create_llm()
 
 
+@_singleton
 def get_text2sql_agent():
-    global TEXT2SQL_SINGLETON
-    if TEXT2SQL_SINGLETON is None:
-        TEXT2SQL_SINGLETON = get_llm().text_to_sql_agent()
-    return TEXT2SQL_SINGLETON
+    return get_llm().text_to_sql_agent()
 
 
+@_singleton
 def get_analysis_agent():
-    global ANALYSIS_SINGLETON
-    if ANALYSIS_SINGLETON is None:
-        ANALYSIS_SINGLETON = get_llm().data_analysis_agent()
-    return ANALYSIS_SINGLETON
+    return get_llm().data_analysis_agent()
 
 
+@_singleton
 def get_sql_judge_agent():
-    global SQL_JUDGE_SINGLETON
-    if SQL_JUDGE_SINGLETON is None:
-        SQL_JUDGE_SINGLETON = get_llm().sql_judge_agent()
-    return SQL_JUDGE_SINGLETON
+    return get_llm().sql_judge_agent()
+
+
+def _prewarm_agents():
+    """后台预热所有 Agent，消除首个请求的冷启动延迟。"""
+    try:
+        get_llm()
+        get_text2sql_agent()
+        get_analysis_agent()
+        get_sql_judge_agent()
+    except Exception as e:
+        print(f"Agent 预热失败: {e}")
+
+
+_PREWARM_LOCK = threading.Lock()
+_PREWARM_THREAD: Optional[threading.Thread] = None
+
+
+def start_prewarm() -> None:
+    """启动后台预热线程（只启动一次）。由服务启动入口调用，导入模块本身不触发 LLM/数据库初始化。"""
+    global _PREWARM_THREAD
+    with _PREWARM_LOCK:
+        if _PREWARM_THREAD is None:
+            _PREWARM_THREAD = threading.Thread(target=_prewarm_agents, name="agent-prewarm", daemon=True)
+            _PREWARM_THREAD.start()
+
+# 分析 Agent 的 table/report 两次调用互不依赖且均为网络 IO：report 放入线程池，table 在请求线程内同时执行。
+# 每个请求只占用一个池线程，池大小与 gthread 请求线程数一致，不会互相排队
+_EXEC = ThreadPoolExecutor(max_workers=32, thread_name_prefix="analysis")
+
+
+def run_analysis(analysis_agent, df: pd.DataFrame, user_nl: str) -> tuple:
+    fr = _EXEC.submit(analysis_agent.run, df, user_nl, mode='report')
+    table = analysis_agent.run(df, user_nl, mode='table')
+    return table, fr.result()
+
+
+def cache_header(res: dict) -> Dict[str, str]:
+    return {"X-Cache": "HIT" if res.get("cached") else "MISS"}
 
 
 def generate_sql_with_validation(user_query: str, db_name: str, table_name: str, db) -> dict:
     """
     闭环：生成SQL -> 判别 -> 根据建议重生成（最多n轮,这里n取3）。
-    返回：{ ok, sql, iterations: [...judge...], last_judge }
+    返回：{ ok, sql, iterations: [...judge...], last_judge, cached }
+    仅缓存判别通过的结果：与 SQL 一起存入 Agent 的 SQL 缓存，共用其规范化键、TTL 与 invalidate()。
     """
+    nlp_agent = get_text2sql_agent()
+    hit = nlp_agent.recall(user_query, db_name, table_name)
+    if hit is not None:
+        return {**hit, "cached": True}
+    res = _generate_sql_with_validation(user_query, db_name, table_name, db)
+    if res.get("ok"):
+        nlp_agent.remember(user_query, db_name, table_name, res["plan"], res["sql_sequence"], result=res)
+    return {**res, "cached": False}
+
+
+def _generate_sql_with_validation(user_query: str, db_name: str, table_name: str, db) -> dict:
     nlp_agent = get_text2sql_agent()
     judge_agent = get_sql_judge_agent()
     iterations = []
     fix: Optional[str] = None
-    sql = nlp_agent.run(
-        user_nl=user_query,
-        database=db_name,
-        table=table_name,
-        conn=db,
-        fix_suggestion=fix,
-    )
-    plan_snapshot = nlp_agent.last_plan or [user_query]
-    sql_sequence_snapshot = nlp_agent.last_sql_sequence or ([sql] if sql else [])
+    sql = ""
+    plan_snapshot = [user_query]
+    sql_sequence_snapshot: List[str] = []
     last_judge = None
+    seen_sqls = set()
+    prev_fix: Optional[str] = None
     for _ in range(5):
+        # 首轮 fix 为 None；之后按上一轮判别的修复建议重生成。生成阶段只需要 SQL 文本，执行交给调用方
+        # Agent 在请求线程间共享，规划与 SQL 序列从返回值获取
+        plan, sql_sequence = nlp_agent.generate(
+            user_nl=user_query,
+            database=db_name,
+            table=table_name,
+            conn=db,
+            fix_suggestion=fix,
+        )
+        sql = sql_sequence[-1] if sql_sequence else ""
+        plan_snapshot = plan or plan_snapshot
+        sql_sequence_snapshot = sql_sequence or sql_sequence_snapshot
+        # 生成结果为空时无需判别
+        if not (sql or "").strip():
+            break
+        # 重新生成了已判别过的 SQL：出现循环，提前结束
+        if sql in seen_sqls:
+            break
+        seen_sqls.add(sql)
         jr = judge_agent.run(user_query, sql, table_name=table_name, db_name=db_name, db=db)
-        # 记录每轮判别及对应SQL
-        it = dict(jr)
-        it["sql"] = sql
-        it["iteration"] = len(iterations) + 1
-        iterations.append(it)
+        # 记录每轮判别及对应SQL（只保留前端展示需要的字段，不整体复制判别结果）
+        iterations.append({
+            "iteration": len(iterations) + 1,
+            "valid": jr.get("valid"),
+            "reason": jr.get("reason", ""),
+            "fix_suggestion": jr.get("fix_suggestion", ""),
+            "sql_nl_explanation": jr.get("sql_nl_explanation", ""),
+            "semantic_similarity": jr.get("semantic_similarity"),
+            "details": jr.get("details") or {},
+            "sql": sql,
+        })
         last_judge = jr
-        plan_snapshot = nlp_agent.last_plan or plan_snapshot
-        sql_sequence_snapshot = nlp_agent.last_sql_sequence or sql_sequence_snapshot
         if jr.get("valid"):
             return {
                 "ok": True,
@@ -214,13 +371,10 @@ def generate_sql_with_validation(user_query: str, db_name: str, table_name: str,
                 "sql_sequence": sql_sequence_snapshot,
             }
         fix = jr.get("fix_suggestion") or ""
-        sql = nlp_agent.run(
-            user_nl=user_query,
-            database=db_name,
-            table=table_name,
-            conn=db,
-            fix_suggestion=fix,
-        )
+        # 修复建议与上一轮相同：模型已陷入不动点，继续重生成无意义
+        if fix == prev_fix:
+            break
+        prev_fix = fix
     return {
         "ok": False,
         "sql": sql,
@@ -228,7 +382,7 @@ def generate_sql_with_validation(user_query: str, db_name: str, table_name: str,
         "last_judge": last_judge,
         "plan": plan_snapshot,
         "sql_sequence": sql_sequence_snapshot,
-    }    
+    }
 
 
 # 聊天界面
@@ -256,15 +410,15 @@ def api_chat():
             user_msg = m.get("content")
             break
     if not user_msg:
-        return {"messages": [{"type": "text", "content": "未检测到用户输入。"}]}
+        return jresp({"messages": [{"type": "text", "content": "未检测到用户输入。"}]})
 
     # 1. 生成 SQL
-    db = create_db()
-    if not db.connect_to_database():
-        return {"messages": [{"type": "text", "content": "数据库连接失败。"}]}
+    db = acquire_db()
+    if db is None:
+        return jresp({"messages": [{"type": "text", "content": "数据库连接失败。"}]})
     try:
         if db_name and not db.select_database(db_name):
-            return {"messages": [{"type": "text", "content": f"无法切换到数据库 {db_name}"}]}
+            return jresp({"messages": [{"type": "text", "content": f"无法切换到数据库 {db_name}"}]})
         # 先进行带判别与修复闭环的 SQL 生成
         loop_res = generate_sql_with_validation(user_msg, db_name, table_name, db)
         sql = normalize_sql(loop_res.get("sql") or "")
@@ -274,20 +428,15 @@ def api_chat():
         # 输出判别过程
         for it in (loop_res.get("iterations") or []):
             valid = bool(it.get("valid"))
-            reason = it.get("reason", "")
-            fix_suggestion = it.get("fix_suggestion", "")
-            it_sql = it.get("sql", "")
-            status = "通过" if valid else "失败"
             explanation = it.get("sql_nl_explanation", "")
-            content_parts = [
-                f"[判别{status}]",
-                f"SQL: {it_sql}",
-                f"原因: {reason}",
-                f"修复建议: {fix_suggestion}",
-            ]
+            content = (
+                f"[判别{'通过' if valid else '失败'}]\n"
+                f"SQL: {it.get('sql', '')}\n"
+                f"原因: {it.get('reason', '')}\n"
+                f"修复建议: {it.get('fix_suggestion', '')}"
+            )
             if explanation:
-                content_parts.append(f"SQL解释: {explanation}")
-            content = "\n".join([part for part in content_parts if part])
+                content += f"\nSQL解释: {explanation}"
             msgs.append({"type": "judge", "valid": valid, "content": content})
         if plan_steps and len(plan_steps) > 1:
             plan_lines = [f"{idx + 1}. {step}" for idx, step in enumerate(plan_steps)]
@@ -307,61 +456,71 @@ def api_chat():
             for step_sql in sql_sequence:
                 if not step_sql:
                     continue
-                step_sql = normalize_sql(step_sql)
-                current_res = db.execute_query(step_sql)
+                step_sql = ensure_limit(normalize_sql(step_sql))
+                current_res = db.execute_query_tuples(step_sql)
                 results = current_res if current_res is not None else results
-            if results and isinstance(results, list) and results and isinstance(results[0], dict):
-                df = results_to_dataframe(results)
+            if results and results[0]:
+                rows, columns = results
+                df = results_to_dataframe(rows, columns=columns)
                 preview_df = df.head(100)
                 msgs.append({"type": "table", "data": df_to_records(preview_df)})
                 # 3. 分析
                 analysis_agent = get_analysis_agent()
-                analysis_table = analysis_agent.run(df, user_msg or "", mode='table')
-                analysis_report = analysis_agent.run(df, user_msg or "", mode='report')
+                analysis_table, analysis_report = run_analysis(analysis_agent, df, user_msg or "")
                 msgs.append({"type": "analysis", "data": str(analysis_table)})
                 msgs.append({"type": "analysis", "data": str(analysis_report)})
             else:
                 msgs.append({"type": "text", "content": "无结果或查询失败。"})
         else:
             msgs.append({"type": "text", "content": "未能生成有效 SQL。"})
-        return {"messages": msgs}
+        return jresp({"messages": msgs}, headers=cache_header(loop_res))
     except Exception as e:
-        return {"messages": [{"type": "text", "content": f"出错: {e}"}]}
+        return jresp({"messages": [{"type": "text", "content": f"出错: {e}"}]})
     finally:
-        db.close()
+        release_db(db)
 
  
 @app.get("/api/databases")
 def api_databases():
     steps = ["连接数据库", "列出数据库"]
-    db = create_db()
-    if not db.connect_to_database():
-        return jsonify({"ok": False, "error": "数据库连接失败", "steps": steps}), 500
+    names = _catalog_get(("dbs",))
+    if names is not None:
+        return jresp({"ok": True, "databases": names, "steps": steps})
+    db = acquire_db()
+    if db is None:
+        return jresp({"ok": False, "error": "数据库连接失败", "steps": steps}, 500)
     try:
-        res = db.execute_query("SHOW DATABASES;")
-        names = rows_to_list(res)
-        return jsonify({"ok": True, "databases": names, "steps": steps})
+        res = db.execute_query_tuples("SHOW DATABASES;")
+        names = rows_to_list(res[0] if res else None)
+        if res is not None:
+            _catalog_put(("dbs",), names)
+        return jresp({"ok": True, "databases": names, "steps": steps})
     finally:
-        db.close()
+        release_db(db)
 
 
 @app.get("/api/tables")
 def api_tables():
     chosen_db = request.args.get("db")
     if not chosen_db:
-        return jsonify({"ok": False, "error": "缺少参数 db"}), 400
+        return jresp({"ok": False, "error": "缺少参数 db"}, 400)
     steps = [f"切换数据库: {chosen_db}", "列出表"]
-    db = create_db()
-    if not db.connect_to_database():
-        return jsonify({"ok": False, "error": "数据库连接失败", "steps": steps}), 500
+    names = _catalog_get(("tbls", chosen_db))
+    if names is not None:
+        return jresp({"ok": True, "tables": names, "steps": steps})
+    db = acquire_db()
+    if db is None:
+        return jresp({"ok": False, "error": "数据库连接失败", "steps": steps}, 500)
     try:
         if not db.select_database(chosen_db):
-            return jsonify({"ok": False, "error": "无法切换到所选数据库", "steps": steps}), 400
-        res = db.execute_query(f"SHOW TABLES FROM `{chosen_db}`;")
-        names = rows_to_list(res)
-        return jsonify({"ok": True, "tables": names, "steps": steps})
+            return jresp({"ok": False, "error": "无法切换到所选数据库", "steps": steps}, 400)
+        res = db.execute_query_tuples(f"SHOW TABLES FROM `{chosen_db}`;")
+        names = rows_to_list(res[0] if res else None)
+        if res is not None:
+            _catalog_put(("tbls", chosen_db), names)
+        return jresp({"ok": True, "tables": names, "steps": steps})
     finally:
-        db.close()
+        release_db(db)
 
 
 @app.post("/api/generate_sql")
@@ -371,40 +530,40 @@ def api_generate_sql():
     table = data.get("table")
     user_nl = data.get("query", "").strip()
     if not database or not table or not user_nl:
-        return jsonify({"ok": False, "error": "参数不完整(database/table/query)"}), 400
+        return jresp({"ok": False, "error": "参数不完整(database/table/query)"}, 400)
 
     t0 = time.time()
     steps = [f"选择数据库: {database}", f"选择表: {table}"]
-    db = create_db()
-    if not db.connect_to_database():
-        return jsonify({"ok": False, "error": "数据库连接失败", "steps": steps}), 500
+    db = acquire_db()
+    if db is None:
+        return jresp({"ok": False, "error": "数据库连接失败", "steps": steps}, 500)
     try:
         if not db.select_database(database):
-            return jsonify({"ok": False, "error": "无法切换到所选数据库", "steps": steps}), 400
+            return jresp({"ok": False, "error": "无法切换到所选数据库", "steps": steps}, 400)
 
         t1 = time.time()
         loop_res = generate_sql_with_validation(user_nl, database, table, db)
         t3 = time.time()
         steps += [f"生成+判别闭环: {(t3 - t1):.2f}s"]
         if not loop_res.get("ok"):
-            return jsonify({
+            return jresp({
                 "ok": False,
                 "error": "未能在多轮修复内生成有效 SQL",
                 "judge": loop_res,
                 "steps": steps,
                 "timing": {"total": round(t3 - t0, 2)}
-            }), 200
-        return jsonify({
+            }, 200, headers=cache_header(loop_res))
+        return jresp({
             "ok": True,
             "sql": loop_res.get("sql"),
             "judge": loop_res,
             "steps": steps,
             "timing": {"total": round(t3 - t0, 2)}
-        })
+        }, headers=cache_header(loop_res))
     except Exception as e:
-        return jsonify({"ok": False, "error": f"生成 SQL 失败: {e}", "steps": steps}), 500
+        return jresp({"ok": False, "error": f"生成 SQL 失败: {e}", "steps": steps}, 500)
     finally:
-        db.close()
+        release_db(db)
 
 @app.post("/api/execute")
 def api_execute():
@@ -413,38 +572,35 @@ def api_execute():
     sql_to_exec = data.get("sql", "").strip()
     user_nl = data.get("query", "").strip()
     table = data.get("table", "")
+    full = bool(data.get("full"))
     if not database or not sql_to_exec:
-        return jsonify({"ok": False, "error": "参数不完整(database/sql)"}), 400
+        return jresp({"ok": False, "error": "参数不完整(database/sql)"}, 400)
 
     t0 = time.time()
     steps = [f"切换数据库: {database}", "执行 SQL", "转为 DataFrame", "数据分析"]
-    db = create_db()
-    if not db.connect_to_database():
-        return jsonify({"ok": False, "error": "数据库连接失败", "steps": steps}), 500
+    db = acquire_db()
+    if db is None:
+        return jresp({"ok": False, "error": "数据库连接失败", "steps": steps}, 500)
 
     try:
         if not db.select_database(database):
-            return jsonify({"ok": False, "error": "无法切换到所选数据库", "steps": steps}), 400
+            return jresp({"ok": False, "error": "无法切换到所选数据库", "steps": steps}, 400)
 
-        results = db.execute_query(sql_to_exec)
-        if not results:
-            return jsonify({"ok": False, "error": "无结果或查询失败", "steps": steps}), 200
+        # 服务端游标分块读取，逐块转为 DataFrame 后拼接，避免 pymysql 缓冲整个结果集
+        stream = db.execute_query_stream(sql_to_exec if full else ensure_limit(sql_to_exec))
+        # 每块与 /api/chat 一样经 results_to_dataframe 构建（Arrow 优先、Decimal 转 float），两个接口的列类型一致
+        frames = [results_to_dataframe(rows, columns=columns) for rows, columns in stream]
+        if not frames:
+            return jresp({"ok": False, "error": "无结果或查询失败", "steps": steps}, 200)
 
         # 结果 -> DataFrame
-        if isinstance(results, list) and results and isinstance(results[0], dict):
-            df = results_to_dataframe(results)
-        elif isinstance(results, list) and results and isinstance(results[0], (list, tuple)):
-            # 若返回元组列表（理论上不会，因为使用了 DictCursor）
-            df = results_to_dataframe(results)
-        else:
-            return jsonify({"ok": False, "error": "结果格式不支持自动分析", "steps": steps}), 200
+        df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True, copy=False)
 
         # 调用数据分析 Agent
         t1 = time.time()
         analysis_agent = get_analysis_agent()
         t2 = time.time()
-        analysis_table = analysis_agent.run(df, user_nl or "", mode='table')
-        analysis_report = analysis_agent.run(df, user_nl or "", mode='report')
+        analysis_table, analysis_report = run_analysis(analysis_agent, df, user_nl or "")
         t3 = time.time()
         steps += [f"分析 Agent 就绪: {(t2 - t1):.2f}s", f"分析用时: {(t3 - t2):.2f}s"]
 
@@ -460,16 +616,50 @@ def api_execute():
             },
         }
         payload["timing"] = {"total": round(time.time() - t0, 2)}
-        return jsonify(payload)
+        return jresp(payload)
     except Exception as e:
-        return jsonify({"ok": False, "error": f"执行失败: {e}", "steps": steps}), 500
+        return jresp({"ok": False, "error": f"执行失败: {e}", "steps": steps}, 500)
     finally:
-        db.close()
+        release_db(db)
 
 
 def _run_dev():
+    start_prewarm()
     app.run(host="0.0.0.0", port=5002, debug=True)
 
 
+def _run_server(host: str = "0.0.0.0", port: int = 5002, threads: int = 32):
+    """
+    生产方式启动：gunicorn 单进程 + gthread 多线程。
+    请求耗时主要在等待 LLM/MySQL 的网络 IO 上，线程即可提供并发，且各线程共享同一份 Agent/连接池。
+    未安装 gunicorn 时回退到 Flask 开发服务器。
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except Exception:
+        print("未安装 gunicorn，使用 Flask 开发服务器")
+        _run_dev()
+        return
+
+    def _post_fork(server, worker):
+        # 在 worker 进程内预热：master 不创建 LLM/连接，也不会把持有中的单例锁带进 fork
+        start_prewarm()
+
+    class _Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{host}:{port}")
+            self.cfg.set("workers", 1)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("threads", threads)
+            # LLM 调用可能持续数十秒
+            self.cfg.set("timeout", 300)
+            self.cfg.set("post_fork", _post_fork)
+
+        def load(self):
+            return app
+
+    _Server().run()
+
+
 if __name__ == "__main__":
-    _run_dev()
+    _run_server()
@@ -3,6 +3,7 @@ LLM配置和初始化模块
 用于配置Qwen3:32B模型和初始化Agent
 """
 import json, datetime
+import functools
 import os
 from qwen_agent.agents import Assistant
 from qwen_agent.llm import get_chat_model
@@ -53,6 +54,9 @@ class LLM:
                 'use_raw_api': False,
             }
         }
+        # 所有 Agent 共用同一个聊天模型与 Assistant，底层 HTTP 客户端的连接池可在各 Agent 间复用
+        self._llm_agent = get_chat_model(self.llm_cfg)
+        self._assistant = Assistant(llm=self._llm_agent)
         # Agent 管理器（可注册/扩展不同的 Agent）
         self.agent_manager = AgentManager()
         
@@ -61,10 +65,7 @@ class LLM:
     def text_to_sql_agent(self) -> Any:
         """返回自然语言转SQL的 Agent 实例（通过 AgentManager 创建），保持 main 的调用方式不变。
         """
-        llm_agent = get_chat_model(self.llm_cfg)
-        assistant = Assistant(llm=llm_agent)
-
-        agent = self.agent_manager.create('text_to_sql', llm_assistant=assistant)
+        agent = self.agent_manager.create('text_to_sql', llm_assistant=self._assistant)
 
         return agent
 
@@ -73,23 +74,20 @@ class LLM:
 
         同时注入一个 LLM Assistant（如需更强的分析文本生成）。
         """
-        llm_agent = get_chat_model(self.llm_cfg)
-        assistant = Assistant(llm=llm_agent)
-
-        agent = self.agent_manager.create('data_analysis', llm_assistant=assistant)
+        agent = self.agent_manager.create('data_analysis', llm_assistant=self._assistant)
 
         return agent
 
     def sql_judge_agent(self) -> Any:
         """返回 SQL 判别 Agent 实例。"""
-        llm_agent = get_chat_model(self.llm_cfg)
-        assistant = Assistant(llm=llm_agent)
-        agent = self.agent_manager.create('sql_judge', llm_assistant=assistant)
+        agent = self.agent_manager.create('sql_judge', llm_assistant=self._assistant)
         return agent
 
 
 
-def create_llm() -> LLM:
+@functools.cache
+def create_llm_config() -> Dict[str, Any]:
+    """读取 .env / 环境变量中的 LLM 配置，进程内只解析一次。"""
     load_dotenv()
     model_name = os.getenv("MODEL_NAME") or None
     model_server = os.getenv("MODEL_SERVER") or None
@@ -127,4 +125,8 @@ def create_llm() -> LLM:
                 'use_raw_api': False,
             }
         }
-    return LLM(**llm_cfg)
+    return llm_cfg
+
+
+def create_llm() -> LLM:
+    return LLM(**create_llm_config())
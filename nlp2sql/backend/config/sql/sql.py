@@ -1,13 +1,18 @@
+import functools
 import os
+import queue
+import threading
 import pymysql
-from pymysql.cursors import DictCursor
-from typing import Optional, Dict, Any
+from pymysql.cursors import Cursor, DictCursor, SSCursor
+from typing import Optional, Dict, Any, Callable, Iterator, List, Tuple
 from dotenv import load_dotenv
 
 class DB:
     """
     - connect_to_database() 返回 bool 表示是否成功连接
     - execute_query() 返回 fetchall 或 fetchone 的结果
+    - execute_query_tuples() 返回 (元组行, 列名)，不为每行构建 dict，适合直接转 DataFrame
+    - execute_query_stream() 使用服务端游标分块返回 (元组行, 列名)，适合大结果集
     - 支持上下文管理
     """
     def __init__(self, host: str, user: str, password: str, database: Optional[str] = None, port: int = 3306, connect_timeout: int = 5):
@@ -15,6 +20,8 @@ class DB:
         self.user = user
         self.password = password
         self.database = database
+        # 连接池复用前据此恢复到初始库
+        self.initial_database = database
         self.port = port
         self.connect_timeout = connect_timeout
         self.connection: Optional[pymysql.connections.Connection] = None
@@ -44,16 +51,53 @@ class DB:
         切换当前连接的数据库。
         若已连接则调用 connection.select_db(database)，否则仅设置属性以便后续连接时使用。
         """
-        self.database = database
         if not self.connection:
+            self.database = database
+            return True
+        if database == self.database:
+            # 连接已在目标库上（连接池复用时常见），无需再发 USE
             return True
         try:
             self.connection.select_db(database)
+            self.database = database
             return True
         except Exception as e:
             print(f"切换数据库失败: {e}")
             return False
+
+    def ping(self) -> bool:
+        """
+        检测连接是否可用，断开时自动重连并恢复当前数据库。
+        """
+        if not self.connection:
+            return self.connect_to_database()
+        try:
+            thread_id = self.connection.thread_id()
+            self.connection.ping(reconnect=True)
+            if self.database and self.connection.thread_id() != thread_id:
+                # 重连后的连接回到初始库，需重新切换
+                self.connection.select_db(self.database)
+            return True
+        except Exception as e:
+            print(f"数据库连接检测失败: {e}")
+            return False
         
+    def reset(self) -> bool:
+        """
+        切回初始库，清除上一个使用者（例如执行了 USE）留下的当前库状态。
+        未配置初始库时无法取消 USE，只清空 database 属性，使下次 select_database() 一定发送 USE。
+        """
+        if not self.connection:
+            return False
+        try:
+            if self.initial_database:
+                self.connection.select_db(self.initial_database)
+            self.database = self.initial_database
+            return True
+        except Exception as e:
+            print(f"重置数据库连接失败: {e}")
+            return False
+
     def execute_query(self, sql: str, fetch: str = "all"):
         if not self.connection:
             print("未连接到数据库，请先调用 connect_to_database()")
@@ -68,6 +112,54 @@ class DB:
             print(f"执行查询失败: {e}")
             return None
 
+    @staticmethod
+    def _column_names(cursor) -> List[str]:
+        return [d[0] for d in cursor.description] if cursor.description else []
+
+    def execute_query_tuples(self, sql: str) -> Optional[Tuple[tuple, List[str]]]:
+        """
+        使用元组游标执行查询，返回 (rows, columns)；失败返回 None。
+        """
+        if not self.connection:
+            print("未连接到数据库，请先调用 connect_to_database()")
+            return None
+        try:
+            with self.connection.cursor(Cursor) as cursor:
+                cursor.execute(sql)
+                return cursor.fetchall(), self._column_names(cursor)
+        except Exception as e:
+            print(f"执行查询失败: {e}")
+            return None
+
+    def execute_query_stream(self, sql: str, chunk: int = 10_000) -> Iterator[Tuple[tuple, List[str]]]:
+        """
+        使用服务端游标（SSCursor）执行查询，按 chunk 行分块产出 (rows, columns)，避免在客户端一次性缓冲整个结果集。
+        查询执行失败时打印错误并结束迭代；已开始产出后读取失败则抛出异常，避免调用方拿到被截断的结果。
+        迭代结束前该连接不可执行其他查询。
+        """
+        if not self.connection:
+            print("未连接到数据库，请先调用 connect_to_database()")
+            return
+        cursor = self.connection.cursor(SSCursor)
+        try:
+            try:
+                cursor.execute(sql)
+            except Exception as e:
+                print(f"执行查询失败: {e}")
+                return
+            columns = self._column_names(cursor)
+            while True:
+                rows = cursor.fetchmany(chunk)
+                if not rows:
+                    break
+                yield rows, columns
+        finally:
+            # 关闭时会读完剩余结果，保证连接可以继续复用；读取已失败时不再掩盖原异常
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
     def close(self):
         if self.connection:
             try:
@@ -85,14 +177,112 @@ class DB:
         self.close()
 
 
-def create_db() -> DB:
-    
+@functools.cache
+def create_db_config() -> Dict[str, Any]:
+    """读取 .env / 环境变量中的数据库配置，进程内只解析一次。"""
     load_dotenv()
-    host = os.getenv("DB_HOST")
-    user = os.getenv("DB_USER")
-    password = os.getenv("DB_PASSWORD")
-    port = int(os.getenv("DB_PORT", 3306))
-    database = os.getenv("DB_NAME") or None
-    connect_timeout = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
-    return DB(host=host, user=user, password=password, database=database, port=port, connect_timeout=connect_timeout)
+    return {
+        "host": os.getenv("DB_HOST"),
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASSWORD"),
+        "port": int(os.getenv("DB_PORT", 3306)),
+        "database": os.getenv("DB_NAME") or None,
+        "connect_timeout": int(os.getenv("DB_CONNECT_TIMEOUT", "5")),
+    }
+
+
+def create_db() -> DB:
+    return DB(**create_db_config())
+
+
+class DBPool:
+    """
+    基于 queue.Queue 的 DB 连接池，复用已建立的连接，避免每个请求都重新握手/认证。
+    - acquire() 返回可用的 DB（必要时新建），借出前回到初始库；失败返回 None
+    - release() 回滚未提交的写入后归还 DB；已断开或回滚失败的连接直接丢弃
+    连接保持非自动提交，与每次请求新建连接、用完直接关闭时一样，请求中的写操作不会生效。
+    """
+    def __init__(self, factory: Callable[[], DB], maxsize: int = 8, timeout: float = 30):
+        self._factory = factory
+        self._maxsize = maxsize
+        self._idle: "queue.LifoQueue[DB]" = queue.LifoQueue(maxsize)
+        self._created = 0
+        self._lock = threading.Lock()
+        self.timeout = timeout
+
+    def _new_db(self) -> Optional[DB]:
+        db = self._factory()
+        if not db.connect_to_database():
+            return None
+        return db
+
+    def _forget(self, db: Optional[DB]) -> None:
+        if db is not None:
+            db.close()
+        with self._lock:
+            self._created -= 1
+
+    def acquire(self) -> Optional[DB]:
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_create = self._created < self._maxsize
+                    if can_create:
+                        self._created += 1
+                if can_create:
+                    db = self._new_db()
+                    if db is None:
+                        self._forget(None)
+                    return db
+                try:
+                    db = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    print("数据库连接池已耗尽，等待超时")
+                    return None
+            if db.ping() and db.reset():
+                return db
+            self._forget(db)
+
+    def release(self, db: DB) -> None:
+        if db.connection is None:
+            self._forget(None)
+            return
+        try:
+            # 结束本次请求的事务：丢弃写入，下次借出时读到新的快照
+            db.connection.rollback()
+        except Exception:
+            self._forget(db)
+            return
+        try:
+            self._idle.put_nowait(db)
+        except queue.Full:
+            self._forget(db)
+
+
+_POOL: Optional[DBPool] = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_db_pool() -> DBPool:
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                create_db_config()  # 确保 .env 已加载
+                # 请求线程在整个生成/判别/分析流程中持有连接，池大小默认与 webapp 的 gthread 线程数一致
+                _POOL = DBPool(create_db, maxsize=int(os.getenv("DB_POOL_SIZE", "32")))
+    return _POOL
+
+
+def acquire_db() -> Optional[DB]:
+    """
+    从连接池借出一个已连接的 DB，失败返回 None；用完需调用 release_db() 归还。
+    """
+    return get_db_pool().acquire()
+
 
+def release_db(db: Optional[DB]) -> None:
+    if db is not None:
+        get_db_pool().release(db)
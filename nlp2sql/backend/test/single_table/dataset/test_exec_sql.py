@@ -1,10 +1,34 @@
+import io
 import os
+import queue
+import re
 import sys
 import json
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, List
+from typing import Any, Callable, Iterable, List, Tuple
 import argparse
 import pymysql
+from pymysql.constants import CLIENT
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:  # 未安装 orjson 时回退到标准库
+    _loads = json.loads
+
+try:
+    import ijson
+except ImportError:  # 可选：仅用于超大行的流式解析
+    ijson = None
+
+# 超过该长度的行改用 ijson 流式提取 sql，不构建整棵对象树
+STREAM_LINE_BYTES = 256 * 1024
+
+# 每批合并发送的语句数，一次往返执行多条
+# 说明：MySQL 经典协议同一连接上不能并发多条请求（无流水线），异步驱动也只能逐条等待；
+# 减少往返依靠本批量发送，并发依靠 --workers 多连接并行处理文件
+BATCH_SIZE = 128
 
 def connect_mysql(host: str, port: int, user: str, password: str, db: str = None):
     return pymysql.connect(
@@ -16,35 +40,246 @@ def connect_mysql(host: str, port: int, user: str, password: str, db: str = None
         charset="utf8mb4",
         autocommit=False,
         cursorclass=pymysql.cursors.DictCursor,
+        client_flag=CLIENT.MULTI_STATEMENTS,
     )
 
-def _split_statements(sql_blob: str) -> List[str]:
-    parts = [p.strip() for p in sql_blob.split(";")]
-    return [p + ";" for p in parts if p]
+def _split_statements(sql_blob: bytes) -> List[bytes]:
+    # 用 find 逐段定位分号，不先生成完整的 split 中间列表
+    out: List[bytes] = []
+    i, n = 0, len(sql_blob)
+    while i < n:
+        j = sql_blob.find(b";", i)
+        if j < 0:
+            j = n
+        p = sql_blob[i:j].strip()
+        if p:
+            out.append(p + b";")
+        i = j + 1
+    return out
 
 def _collect_sqls(obj: Any) -> List[str]:
+    """
+    收集所有键名包含 sql 的字符串值（或字符串列表），顺序与递归先序遍历一致。
+    用显式栈代替递归；JSON 解析结果中不会出现 tuple，因此用 (v,) 标记“待输出的 sql 值”。
+    """
     found: List[str] = []
-    def rec(x: Any):
-        if isinstance(x, dict):
+    stack: List[Any] = [obj]
+    while stack:
+        x = stack.pop()
+        t = type(x)
+        if t is tuple:
+            v = x[0]
+            if type(v) is str:
+                found.append(v)
+            else:
+                found.extend(it for it in v if type(it) is str)
+        elif t is dict:
+            todo: List[Any] = []
             for k, v in x.items():
-                if isinstance(k, str) and "sql" in k.lower():
-                    if isinstance(v, str):
-                        found.append(v)
-                    elif isinstance(v, list):
-                        for it in v:
-                            if isinstance(it, str):
-                                found.append(it)
-                rec(v)
-        elif isinstance(x, list):
-            for it in x:
-                rec(it)
-    rec(obj)
+                if type(k) is str and "sql" in k.lower() and type(v) in (str, list):
+                    todo.append((v,))
+                todo.append(v)
+            todo.reverse()
+            stack.extend(todo)
+        elif t is list:
+            stack.extend(reversed(x))
+    return found
+
+def _collect_sqls_events(events: Iterable[Tuple[str, str, Any]]) -> List[str]:
+    """
+    基于 ijson.parse 事件流收集 sql，结果及顺序与 _collect_sqls 一致。
+    帧：[类型, 当前键, 是否 sql 数组, 输出目标, 延后输出]；sql 数组内嵌套对象中的 sql
+    按 _collect_sqls 的顺序排在该数组直接字符串之后，因此先暂存到“延后输出”，数组结束时再并入。
+    """
+    found: List[str] = []
+    stack: List[list] = []
+
+    def child_target() -> List[str]:
+        if not stack:
+            return found
+        top = stack[-1]
+        return top[4] if top[2] else top[3]
+
+    for _prefix, event, value in events:
+        if event == "map_key":
+            stack[-1][1] = value
+        elif event == "string":
+            if stack:
+                top = stack[-1]
+                if top[0] == "map" and "sql" in top[1].lower():
+                    top[3].append(value)
+                elif top[2]:
+                    top[3].append(value)
+        elif event == "start_map":
+            stack.append(["map", "", False, child_target(), None])
+        elif event == "start_array":
+            is_sql = bool(stack) and stack[-1][0] == "map" and "sql" in stack[-1][1].lower()
+            stack.append(["array", "", is_sql, child_target(), [] if is_sql else None])
+        elif event in ("end_map", "end_array"):
+            frame = stack.pop()
+            if frame[2]:
+                frame[3].extend(frame[4])
     return found
 
+def _collect_sqls_stream(line: bytes) -> List[str]:
+    return _collect_sqls_events(ijson.parse(io.BytesIO(line)))
+
+# 语句以 bytes 形式处理（pymysql 直接发送 bytes），只匹配开头关键字，不对整条语句做 lower()
+_IS_SELECT = re.compile(rb"\s*select\b", re.IGNORECASE).match
+
+# INSERT ... VALUES (...) 单行插入：prefix 为 VALUES 及之前的部分，rows 为值列表
+_INSERT_VALUES = re.compile(rb"(\s*insert\s+(?:ignore\s+)?into\s+[^(;]+?(?:\([^)]*\))?\s*values)\s*(\(.*\))\s*;", re.IGNORECASE | re.DOTALL).fullmatch
+_INSERT_TAIL = re.compile(rb"\)\s*(?:on\s+duplicate|as\s)", re.IGNORECASE).search
+
+# DDL 会隐式提交：其本身及之前已执行的语句都无法再回滚
+_IS_DDL = re.compile(rb"\s*(?:create|alter|drop|truncate|rename)\b", re.IGNORECASE).match
+
+def _coalesce_inserts(stmts: List[bytes]) -> List[Tuple[bytes, int]]:
+    """
+    将相邻、目标表与列相同的单行 INSERT ... VALUES 合并为一条多行 INSERT，减少服务端解析次数。
+    无法识别的语句（含 ON DUPLICATE / 别名等）原样保留。
+    返回 (语句, 对应的原语句条数)，用于出错时定位已执行到的原语句。
+    """
+    out: List[Tuple[bytes, int]] = []
+    prefix: bytes = b""
+    rows: List[bytes] = []
+
+    def flush():
+        if rows:
+            out.append((prefix + b" " + b",".join(rows) + b";", len(rows)))
+            rows.clear()
+
+    for stmt in stmts:
+        m = _INSERT_VALUES(stmt)
+        if m is None or _INSERT_TAIL(m.group(2)):
+            flush()
+            out.append((stmt, 1))
+            continue
+        if m.group(1) != prefix:
+            flush()
+            prefix = m.group(1)
+        rows.append(m.group(2))
+    flush()
+    return out
+
+def _exec_one(conn, cur, name: str, lineno: int, seq: int, stmt: bytes, show_success: bool, log: Callable[[str], None]) -> bool:
+    try:
+        cur.execute(stmt)
+        if not _IS_SELECT(stmt):
+            conn.commit()
+        if show_success:
+            # 显示成功
+            if _IS_SELECT(stmt):
+                _ = cur.fetchall()
+            log(f"[OK] {name}:line {lineno} stmt#{seq}")
+        return True
+    except Exception as e:
+        log(f"[ERROR][EXEC] {name}:line {lineno} stmt#{seq} => {e}")
+        log(stmt.decode("utf-8", "replace"))
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        return False
+
+def _exec_batch(conn, cur, name: str, batch: List[Tuple[int, int, bytes]], show_success: bool, log: Callable[[str], None]) -> int:
+    """
+    合并一批语句一次发送（MULTI_STATEMENTS，相邻单行 INSERT 合并为多行 INSERT），用 nextset() 取完所有结果集，成功后提交；返回失败条数。
+    批内出错时回滚并逐条重跑，保留精确的行号/语句号报错；出错前已执行的 DDL 连同其之前的语句已被隐式提交，不再重跑。
+    """
+    if not batch:
+        return 0
+    sent = _coalesce_inserts([stmt for _, _, stmt in batch])
+    done = 0
+    try:
+        cur.execute(b"\n".join(stmt for stmt, _ in sent))
+        done = 1
+        while cur.nextset():
+            done += 1
+        conn.commit()
+    except Exception:
+        try:
+            # 连接可能已断开（超时/服务端重启），先探活重连再回滚；断开时服务端已回滚未提交部分
+            conn.ping(reconnect=True)
+        except Exception:
+            pass
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        committed = 0
+        pos = 0
+        for i, (stmt, count) in enumerate(sent[:done + 1]):
+            if _IS_DDL(stmt):
+                # DDL 执行前先隐式提交之前的语句；执行成功（i < done）时其本身也已生效
+                committed = pos + count if i < done else pos
+            pos += count
+        if committed and show_success:
+            for lineno, seq, _ in batch[:committed]:
+                log(f"[OK] {name}:line {lineno} stmt#{seq}")
+        return sum(not _exec_one(conn, cur, name, lineno, seq, stmt, show_success, log) for lineno, seq, stmt in batch[committed:])
+    if show_success:
+        for lineno, seq, _ in batch:
+            log(f"[OK] {name}:line {lineno} stmt#{seq}")
+    return 0
+
+def process_file(path: Path, pool: "queue.Queue", show_success: bool) -> Tuple[int, int, List[str]]:
+    """
+    处理单个 jsonl 文件：从连接池借一个连接执行其中所有 sql，每批执行成功后提交。
+    返回 (语句数, 失败数, 输出行)；输出先缓存，由主线程按文件顺序统一打印，避免多线程输出交错。
+    """
+    out: List[str] = [f"\n[FILE] 开始: {path.name}"]
+    log = out.append
+    file_sql = 0
+    file_failed = 0
+    batch: List[Tuple[int, int, bytes]] = []
+    conn = pool.get()
+    try:
+        # 池中连接可能空闲过久，借出时探活并按需重连
+        conn.ping(reconnect=True)
+        with conn.cursor() as cur:
+            # 二进制模式 + 1 MiB 缓冲读取，跳过逐行解码，bytes 直接交给 JSON 解析（首尾空白由解析器忽略）
+            with open(path, "rb", buffering=1 << 20) as f:
+                for lineno, line in enumerate(f, start=1):
+                    if line.isspace():
+                        continue
+                    try:
+                        if ijson is not None and len(line) > STREAM_LINE_BYTES:
+                            sql_blobs = _collect_sqls_stream(line)
+                        else:
+                            sql_blobs = _collect_sqls(_loads(line))
+                    except Exception as e:
+                        log(f"[ERROR][PARSE] {path.name}:line {lineno} => {e}")
+                        continue
+                    if not sql_blobs:
+                        continue
+                    stmt_seq = 0
+                    for blob in sql_blobs:
+                        for stmt in _split_statements(blob.encode("utf-8")):
+                            # _split_statements 只产出去除空白后的非空语句，无需再次判空
+                            stmt_seq += 1
+                            file_sql += 1
+                            batch.append((lineno, stmt_seq, stmt))
+                            if len(batch) >= BATCH_SIZE:
+                                file_failed += _exec_batch(conn, cur, path.name, batch, show_success, log)
+                                batch = []
+            file_failed += _exec_batch(conn, cur, path.name, batch, show_success, log)
+    except Exception as e:
+        log(f"[ERROR][FILE] 读取失败 {path.name}: {e}")
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+    finally:
+        pool.put(conn)
+    log(f"[FILE] 结束: {path.name} 总语句 {file_sql} 失败 {file_failed}")
+    return file_sql, file_failed, out
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--dir", default="/home/minshunhua/data/P2/nlp2sql/backend/test/single_table/dataset", help="包含 jsonl 的目录")
     ap.add_argument("--show-success", action="store_true", help="也输出成功语句(默认只输出失败)")
+    ap.add_argument("--workers", type=int, default=4, help="并行处理文件的线程数（每个线程独占一个数据库连接）")
     args = ap.parse_args()
 
     host = os.getenv("DB_HOST", "127.0.0.1")
@@ -66,77 +301,38 @@ def main():
     if not files:
         return
 
+    workers = max(1, min(args.workers, len(files)))
+    pool: "queue.Queue" = queue.Queue()
+    conns = []
     try:
-        conn = connect_mysql(host, port, user, password, database if database else None)
+        for _ in range(workers):
+            conns.append(connect_mysql(host, port, user, password, database if database else None))
     except Exception as e:
         print(f"[FATAL] 数据库连接失败: {e}")
+        for c in conns:
+            c.close()
         sys.exit(3)
-
-    cur = conn.cursor()
+    for c in conns:
+        pool.put(c)
 
     total_files = 0
     total_sql = 0
     total_failed = 0
 
-    for path in files:
-        total_files += 1
-        print(f"\n[FILE] 开始: {path.name}")
-        file_sql = 0
-        file_failed = 0
-        try:
-            with path.open("r", encoding="utf-8") as f:
-                for lineno, line in enumerate(f, start=1):
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        obj = json.loads(line)
-                    except Exception as e:
-                        print(f"[ERROR][PARSE] {path.name}:line {lineno} => {e}")
-                        continue
-                    sql_blobs = _collect_sqls(obj)
-                    if not sql_blobs:
-                        continue
-                    stmt_seq = 0
-                    for blob in sql_blobs:
-                        for stmt in _split_statements(blob):
-                            stmt_seq += 1
-                            file_sql += 1
-                            total_sql += 1
-                            if not stmt.strip():
-                                continue
-                            try:
-                                cur.execute(stmt)
-                                if not args.show_success:
-                                    # 成功且不显示
-                                    if not stmt.lower().startswith("select"):
-                                        conn.commit()
-                                else:
-                                    # 显示成功
-                                    if stmt.lower().startswith("select"):
-                                        _ = cur.fetchall()
-                                    else:
-                                        conn.commit()
-                                    print(f"[OK] {path.name}:line {lineno} stmt#{stmt_seq}")
-                            except Exception as e:
-                                file_failed += 1
-                                total_failed += 1
-                                print(f"[ERROR][EXEC] {path.name}:line {lineno} stmt#{stmt_seq} => {e}")
-                                print(stmt)
-                                try:
-                                    conn.rollback()
-                                except Exception:
-                                    pass
-        except Exception as e:
-            print(f"[ERROR][FILE] 读取失败 {path.name}: {e}")
-        print(f"[FILE] 结束: {path.name} 总语句 {file_sql} 失败 {file_failed}")
-
     try:
-        cur.close()
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            futures = [ex.submit(process_file, path, pool, args.show_success) for path in files]
+            for fut in futures:
+                file_sql, file_failed, out = fut.result()
+                total_files += 1
+                total_sql += file_sql
+                total_failed += file_failed
+                print("\n".join(out))
     finally:
-        conn.close()
+        for c in conns:
+            c.close()
 
     print(f"\n[SUMMARY] 文件数 {total_files} 语句总数 {total_sql} 失败总数 {total_failed}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
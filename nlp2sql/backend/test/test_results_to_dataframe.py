@@ -0,0 +1,27 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+pytest.importorskip("flask")
+pytest.importorskip("qwen_agent")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.webapp import results_to_dataframe  # noqa: E402
+
+
+def test_duplicate_columns_keep_numeric_values():
+    # SELECT a, a FROM t：Arrow 路径会把重复列名的整数列转成字符串，应回退到 pandas 路径
+    df = results_to_dataframe([(1, 1), (2, 2)], columns=["a", "a"])
+    assert list(df.columns) == ["a", "a"]
+    assert df.iloc[:, 0].tolist() == [1, 2]
+    assert df.iloc[:, 1].tolist() == [1, 2]
+
+
+def test_unique_columns_use_arrow_dtypes():
+    df = results_to_dataframe([(1, "x"), (2, None)], columns=["a", "b"])
+    assert isinstance(df["a"].dtype, pd.ArrowDtype)
+    assert df["a"].tolist() == [1, 2]
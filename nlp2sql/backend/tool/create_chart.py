@@ -1,5 +1,4 @@
 from __future__ import annotations
-import json
 import datetime
 from pathlib import Path
 
@@ -36,11 +35,9 @@ def create_chart(
       - bar: 树状图
       - line: 折线图
       - pie: 扇形图/饼图
+    data 字段为列式结构：{"columns": [x, y], "values": [x 列数组, y 列数组]}。
     返回 JSON 文件路径。
     """
-    import matplotlib.pyplot as plt
-
-
     if x not in df.columns or y not in df.columns:
         raise ValueError(f"列不存在: x={x}, y={y}")
     if chart_type not in ChartType:
@@ -52,8 +49,9 @@ def create_chart(
     out_dir.mkdir(parents=True, exist_ok=True)
     fpath = out_dir / fname
 
-    # 限制数据量，避免生成超大 JSON
-    data_rows = df[[x, y]].head(max_points).to_dict("records")
+    # 限制数据量，避免生成超大 JSON；按列输出数组，不逐行构建 dict（plot_df 同时供绘图复用）
+    plot_df = df[[x, y]].head(max_points)
+    data_rows = {"columns": [x, y], "values": [plot_df[x].to_numpy(), plot_df[y].to_numpy()]}
     data = {
         "type": chart_type.value,
         "x": x,
@@ -71,9 +69,9 @@ def create_chart(
 
     # # 生成图片
     # if save_image:
+    #     import matplotlib.pyplot as plt
     #     img_path = fpath.with_suffix('.png')
     #     fig, ax = plt.subplots()
-    #     plot_df = df[[x, y]].head(max_points)
     #     if chart_type == ChartType.BAR:
     #         ax.bar(plot_df[x], plot_df[y])
     #         ax.set_xlabel(x_label or x)
@@ -84,8 +82,8 @@ def create_chart(
     #         ax.set_ylabel(y_label or y)
     #     elif chart_type == ChartType.PIE:
     #         # 饼图只用 y
-    #         plot_df = plot_df.groupby(x)[y].sum().reset_index()
-    #         ax.pie(plot_df[y], labels=plot_df[x], autopct='%1.1f%%')
+    #         pie_df = plot_df.groupby(x)[y].sum().reset_index()
+    #         ax.pie(pie_df[y], labels=pie_df[x], autopct='%1.1f%%')
     #     ax.set_title(title or f"{chart_type.value.capitalize()} Chart: {y} by {x}")
     #     fig.tight_layout()
     #     # fig.savefig(img_path, dpi=150)
@@ -1,9 +1,8 @@
 from __future__ import annotations
 import datetime
-import uuid
+import os
 from pathlib import Path
 from typing import Any
-import json
 
 def create_table(
     df: Any,
@@ -18,12 +17,12 @@ def create_table(
     img_dpi: int = 150
 ) -> str:
     """
-    将 DataFrame 导出为带元数据的 JSON（records 结构），支持表标题、唯一ID、可选 cache_id。
+    将 DataFrame 导出为带元数据的 JSON（列式结构：columns + values），支持表标题、唯一ID、可选 cache_id。
     同时（可选）生成一张二维表格的 PNG 图片保存到同目录。
     返回生成的 JSON 相对路径。
     """         
     ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    unique_id = uuid.uuid4().hex[:8]
+    unique_id = os.urandom(4).hex()  # 8 位十六进制，等价于 uuid4().hex[:8]，开销更小
     fname = f"table_{unique_id}.json"
     out_dir = Path(output_dir) if output_dir else Path.cwd()
     out_dir.mkdir(parents=True, exist_ok=True)
@@ -34,7 +33,8 @@ def create_table(
     table_data_output = {
         "title": title,
         "columns": df_display.columns.tolist(),
-        "data": df_display.to_dict("records"),
+        # 列式存储：values[i] 为第 i 列的取值数组，不逐行构建 dict
+        "values": [df_display.iloc[:, i].to_numpy() for i in range(df_display.shape[1])],
         "metadata": {
             "total_rows": len(df),
             "displayed_rows": len(df_display),
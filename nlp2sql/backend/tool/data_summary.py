@@ -1,14 +1,20 @@
 from __future__ import annotations
 from typing import Any
-import pandas as pd
 from pandas.api.types import is_numeric_dtype, is_datetime64_any_dtype
 
+# to_markdown 依赖 tabulate：导入时检测一次，避免每次调用都走 ImportError 回退
+try:
+    import tabulate  # noqa: F401
+    _HAS_TABULATE = True
+except ImportError:
+    _HAS_TABULATE = False
+
 
 def data_summary(df: Any) -> str:
     """
     返回数据概览信息，包含字段、记录数与简单的取值范围/统计，并稳健地渲染预览。
 
-    - 优先使用 DataFrame.to_markdown（若 tabulate 未安装则回退到 to_string）。
+    - 优先使用 DataFrame.to_markdown（tabulate 未安装时直接使用 to_string）。
     - 仅展示前 10 行，避免输出过大。
     - 对数值列给出 min/max。
     - 非数值列仅在“字段”列表里展示名称，不再计算额外的统计，避免误导或高开销。
@@ -25,37 +31,44 @@ def data_summary(df: Any) -> str:
     lines = []
     lines.append(f"字段: {cols}")
     lines.append(f"记录数: {n}")
+    if n == 0:
+        # 空表：无统计与预览可做
+        lines.append("空数据表")
+        return "\n".join(lines)
 
-    # 仅对数值列计算简单统计（min/max/sum）
+    # 仅对数值列计算简单统计（min/max/sum），一次 agg 完成三种聚合
     try:
+        num_idx = [i for i, dt in enumerate(df.dtypes) if is_numeric_dtype(dt)]
         stats = []
-        for c in cols:
+        if num_idx:
             try:
-                s = df[c]
-                if is_numeric_dtype(s):
-                    # 更稳妥地计算数值 min/max（考虑到可能含有非数值/缺失）
-                    s_num = pd.to_numeric(s, errors='coerce')
-                    vmin = s_num.min()
-                    vmax = s_num.max()
-                    vsum = s_num.sum()
-                    stats.append(f"- {c} (数值): min={vmin}, max={vmax}, sum={vsum}")
-                # 非数值列不额外统计，保持简单明了
+                agg = df.iloc[:, num_idx[:20]].agg(["min", "max", "sum"])  # 最多展示 20 条，避免过长
+                stats = [
+                    f"- {c} (数值): min={agg.iloc[0, j]}, max={agg.iloc[1, j]}, sum={agg.iloc[2, j]}"
+                    for j, c in enumerate(agg.columns)
+                ]
             except Exception:
-                continue
+                # 合并聚合失败时逐列计算，只跳过出错的列
+                for i in num_idx:
+                    try:
+                        vmin, vmax, vsum = df.iloc[:, i].agg(["min", "max", "sum"])
+                    except Exception:
+                        continue
+                    stats.append(f"- {df.columns[i]} (数值): min={vmin}, max={vmax}, sum={vsum}")
+                    if len(stats) >= 20:
+                        break
         if stats:
             lines.append("字段范围/统计 (仅数值列，含求和):")
-            lines.extend(stats[:20])  # 最多展示 20 条，避免过长
+            lines.extend(stats)
     except Exception:
         pass
 
     # 预览
     try:
-        preview = df.head(10).to_markdown(index=False)  # 依赖 tabulate
+        head = df.head(10)
+        preview = head.to_markdown(index=False) if _HAS_TABULATE else head.to_string(index=False)
     except Exception:
-        try:
-            preview = df.head(10).to_string(index=False)
-        except Exception:
-            preview = "<无法渲染预览>"
+        preview = "<无法渲染预览>"
     lines.append("示例数据:")
     lines.append(preview)
 